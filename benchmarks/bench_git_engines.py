@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Compares the vault commit engines (see GIT_ENGINES in gcalvault.py) on
+# synthetic vaults with many .ics files. Usage:
+#   python benchmarks/bench_git_engines.py [<file-count>] [<changed-count>] [<rounds>]
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import contextlib
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from gcalvault.gcalvault import GIT_ENGINES  # noqa: E402
+
+
+def main(file_count=5000, changed_count=50, rounds=5):
+    print(f"{file_count} files, {changed_count} changed per round, {rounds} round(s)")
+    for engine_name, engine_cls in GIT_ENGINES.items():
+        work_dir = tempfile.mkdtemp(prefix=f"gcalvault-bench-{engine_name}-")
+        try:
+            rng = random.Random(0)
+            file_names = [f"cal{i:06d}@group.calendar.google.com.ics" for i in range(file_count)]
+
+            def write_and_add(repo, names, round_num):
+                for file_name in names:
+                    with open(os.path.join(work_dir, file_name), 'w') as file:
+                        file.write(_ics(file_name, round_num))
+                    repo.add_file(file_name)
+
+            with contextlib.redirect_stdout(StringIO()):
+                repo = engine_cls("gcalvault", "bench", work_dir, [".ics"])
+                start = time.perf_counter()
+                write_and_add(repo, file_names, 0)
+                repo.commit("gcalvault sync")
+            initial = time.perf_counter() - start
+
+            incremental = []
+            for round_num in range(1, rounds + 1):
+                with contextlib.redirect_stdout(StringIO()):
+                    repo = engine_cls("gcalvault", "bench", work_dir, [".ics"])
+                    start = time.perf_counter()
+                    write_and_add(repo, rng.sample(file_names, changed_count), round_num)
+                    repo.commit("gcalvault sync")
+                incremental.append(time.perf_counter() - start)
+
+            print(f"{engine_name:>12}: initial commit {initial:8.3f}s, "
+                  f"incremental commit {sum(incremental) / len(incremental):8.3f}s (avg)")
+        finally:
+            shutil.rmtree(work_dir)
+
+
+def _ics(file_name, round_num):
+    events = "".join(
+        f"BEGIN:VEVENT\r\nUID:{file_name}-{i}\r\nSEQUENCE:{round_num}\r\n"
+        f"DTSTART:20210101T{i % 24:02d}0000Z\r\nSUMMARY:Event {i} rev {round_num}\r\nEND:VEVENT\r\n"
+        for i in range(20))
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n{events}END:VCALENDAR\r\n"
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -37,6 +37,12 @@ setup(
         "python-dotenv==1.1.*",
     ],
     extras_require={
+        "async": [
+            "httpx[http2]==0.28.*",
+        ],
+        "export": [
+            "pyarrow>=14",
+        ],
         "dev": [
             "pycodestyle",
             "setuptools",
@@ -0,0 +1,93 @@
+import io
+import xml.etree.ElementTree as ET
+
+
+# Helpers for CalDAV calendar-query REPORTs (RFC 4791, section 7.8), used to
+# export only the events that fall within a time range.
+
+DAV_NS = "DAV:"
+CALDAV_NS = "urn:ietf:params:xml:ns:caldav"
+
+REPORT_HEADERS = {
+    'Depth': '1',
+    'Content-Type': 'application/xml; charset=utf-8',
+}
+
+
+def calendar_query_body(time_min, time_max, with_data=True):
+    time_range = ""
+    if time_min is not None:
+        time_range += f' start="{_format_utc(time_min)}"'
+    if time_max is not None:
+        time_range += f' end="{_format_utc(time_max)}"'
+    data = "<C:calendar-data/>" if with_data else ""
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<C:calendar-query xmlns:D="{DAV_NS}" xmlns:C="{CALDAV_NS}">'
+        f'<D:prop><D:getetag/>{data}</D:prop>'
+        '<C:filter><C:comp-filter name="VCALENDAR"><C:comp-filter name="VEVENT">'
+        f'<C:time-range{time_range}/>'
+        '</C:comp-filter></C:comp-filter></C:filter>'
+        '</C:calendar-query>'
+    ).encode('utf-8')
+
+
+def iter_multistatus(content):
+    for (_, element) in ET.iterparse(io.BytesIO(content), events=('end',)):
+        if element.tag != f"{{{DAV_NS}}}response":
+            continue
+        href = element.findtext(f"{{{DAV_NS}}}href", default="")
+        etag = element.findtext(f".//{{{DAV_NS}}}getetag", default="")
+        calendar_data = element.findtext(f".//{{{CALDAV_NS}}}calendar-data")
+        yield (href, etag, calendar_data)
+        element.clear()
+
+
+def merge_calendars(calendar_datas):
+    header = None
+    timezones = {}
+    events = []
+    for calendar_data in calendar_datas:
+        (calendar_header, components) = _split_calendar(calendar_data)
+        if header is None:
+            header = calendar_header
+        for component in components:
+            if component[0] == "BEGIN:VTIMEZONE":
+                tzid = next((line for line in component if line.startswith("TZID")), "")
+                timezones.setdefault(tzid, component)
+            else:
+                events.append(component)
+
+    lines = ["BEGIN:VCALENDAR"] + (header or ["VERSION:2.0"])
+    for component in list(timezones.values()) + events:
+        lines.extend(component)
+    lines.append("END:VCALENDAR")
+    return "".join(f"{line}\r\n" for line in lines)
+
+
+def _split_calendar(calendar_data):
+    header = []
+    components = []
+    component = None
+    depth = 0
+    for line in calendar_data.splitlines():
+        if line in ("BEGIN:VCALENDAR", "END:VCALENDAR") or not line:
+            continue
+        if line.startswith("BEGIN:"):
+            if depth == 0:
+                component = []
+            depth += 1
+        if component is not None:
+            component.append(line)
+        else:
+            header.append(line)
+        if line.startswith("END:"):
+            depth -= 1
+            if depth == 0:
+                components.append(component)
+                component = None
+    return (header, components)
+
+
+def _format_utc(value):
+    return value.strftime("%Y%m%dT%H%M%SZ")
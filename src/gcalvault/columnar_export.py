@@ -0,0 +1,158 @@
+import os
+import glob
+import tempfile
+
+from .ical import iter_events
+from .file_lock import write_atomic
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = {
+    'parquet': ".parquet",
+    'arrow': ".arrow",
+}
+
+# Events are parsed and written in batches of this size, so memory use is
+# bounded regardless of calendar size.
+BATCH_SIZE = 10000
+
+STATE_FILE_NAME = ".gcalvault-export"
+
+
+def schema():
+    return pyarrow.schema([
+        ('calendar_id', pyarrow.string()),
+        ('uid', pyarrow.string()),
+        ('recurrence_id', pyarrow.string()),
+        ('sequence', pyarrow.int32()),
+        ('status', pyarrow.string()),
+        ('summary', pyarrow.string()),
+        ('start', pyarrow.string()),
+        ('end', pyarrow.string()),
+        ('tzid', pyarrow.string()),
+        ('all_day', pyarrow.bool_()),
+        ('rrule', pyarrow.string()),
+        ('organizer', pyarrow.string()),
+        ('attendees', pyarrow.list_(pyarrow.string())),
+        ('last_modified', pyarrow.string()),
+    ])
+
+
+class ColumnarExporter():
+
+    def __init__(self, export_dir, user, format='parquet', batch_size=BATCH_SIZE):
+        if pyarrow is None:
+            raise RuntimeError(
+                "Export requires the 'export' extra, install it with: pip install 'gcalvault[export]'")
+        self._format = format
+        self._batch_size = batch_size
+        # Hive-style partitioning, so the exports of many users' vaults can be
+        # read together as a single dataset, with 'user' as a column
+        self._user_dir_path = os.path.join(export_dir, f"user={user}")
+        self._state_file_path = os.path.join(self._user_dir_path, STATE_FILE_NAME)
+        os.makedirs(self._user_dir_path, exist_ok=True)
+        self._state = self._read_state_file()
+
+    def export_calendar(self, calendar_id, cal_file_path):
+        stat = os.stat(cal_file_path)
+        signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+        out_file_path = self._out_file_path(calendar_id)
+        # Per format, as exports in other formats don't update this one's file
+        key = (calendar_id, self._format)
+        if self._state.get(key) == signature and os.path.exists(out_file_path):
+            return None
+
+        (fd, temp_file_path) = tempfile.mkstemp(dir=self._user_dir_path, prefix=".")
+        os.close(fd)
+        try:
+            event_count = self._write_events(calendar_id, cal_file_path, temp_file_path)
+            os.replace(temp_file_path, out_file_path)
+        except BaseException:
+            os.remove(temp_file_path)
+            raise
+
+        self._state[key] = signature
+        return event_count
+
+    def remove_calendars_except(self, calendar_ids):
+        removed = []
+        for (calendar_id, format) in list(self._state):
+            if calendar_id not in calendar_ids:
+                del self._state[(calendar_id, format)]
+                if calendar_id not in removed:
+                    removed.append(calendar_id)
+        for ext in FORMATS.values():
+            for out_file_path in glob.glob(os.path.join(glob.escape(self._user_dir_path), f"*{ext}")):
+                if os.path.basename(out_file_path)[:-len(ext)] not in calendar_ids:
+                    os.remove(out_file_path)
+        return removed
+
+    def save_state(self):
+        write_atomic(
+            self._state_file_path,
+            "".join(f"{calendar_id}\t{format}\t{signature}\n"
+                    for ((calendar_id, format), signature) in self._state.items()),
+            fsync=False)  # Losing it in a crash just means exporting again
+
+    def _write_events(self, calendar_id, cal_file_path, out_file_path):
+        event_count = 0
+        with open(cal_file_path, 'r') as file, self._open_writer(out_file_path) as writer:
+            columns = _empty_columns()
+            for event in iter_events(file):
+                (start, tzid) = event.start
+                (end, _) = event.end
+                (last_modified, _) = event.get_datetime('LAST-MODIFIED')
+                row = {
+                    'calendar_id': calendar_id,
+                    'uid': event.uid,
+                    'recurrence_id': event.get_datetime('RECURRENCE-ID')[0],
+                    'sequence': event.sequence,
+                    'status': event.get('STATUS'),
+                    'summary': event.summary,
+                    'start': start,
+                    'end': end,
+                    'tzid': tzid,
+                    'all_day': event.all_day,
+                    'rrule': event.get('RRULE'),
+                    'organizer': event.organizer,
+                    'attendees': event.attendees,
+                    'last_modified': last_modified,
+                }
+                for name, value in row.items():
+                    columns[name].append(value)
+                event_count += 1
+                if len(columns['uid']) >= self._batch_size:
+                    writer.write_batch(pyarrow.RecordBatch.from_pydict(columns, schema=schema()))
+                    columns = _empty_columns()
+            if columns['uid'] or event_count == 0:
+                writer.write_batch(pyarrow.RecordBatch.from_pydict(columns, schema=schema()))
+        return event_count
+
+    def _open_writer(self, out_file_path):
+        if self._format == 'arrow':
+            return pyarrow.ipc.new_file(out_file_path, schema())
+        return pyarrow.parquet.ParquetWriter(out_file_path, schema())
+
+    def _out_file_path(self, calendar_id):
+        return os.path.join(self._user_dir_path, f"{calendar_id}{FORMATS[self._format]}")
+
+    def _read_state_file(self):
+        state = {}
+        if os.path.exists(self._state_file_path):
+            with open(self._state_file_path, 'r') as file:
+                for line in file:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 3:  # Otherwise from before formats were tracked, exported again
+                        (calendar_id, format, signature) = fields
+                        state[(calendar_id, format)] = signature
+        return state
+
+
+def _empty_columns():
+    return {field.name: [] for field in schema()}
@@ -0,0 +1,81 @@
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from .file_lock import file_lock, write_atomic
+
+
+# Refresh tokens this long before they actually expire, so that downloads
+# started near the end of a token's lifetime don't fail halfway through.
+DEFAULT_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+class CredentialManager():
+
+    # Shared by all instances, so credentials are cached (and refreshes are
+    # coalesced) across users and sync cycles within the same process.
+    _cache = {}
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+
+    def load(self, token_file_path, scopes):
+        with self._lock(token_file_path):
+            credentials = self._cache.get(token_file_path)
+            if credentials is None and os.path.exists(token_file_path):
+                credentials = Credentials.from_authorized_user_file(token_file_path, scopes)
+                self._cache[token_file_path] = credentials
+            return credentials
+
+    def save(self, credentials, token_file_path):
+        with self._lock(token_file_path), self._file_lock(token_file_path):
+            self._write_atomic(credentials, token_file_path)
+            self._cache[token_file_path] = credentials
+
+    def needs_refresh(self, credentials):
+        if not credentials.token:
+            return True
+        if credentials.expiry is None:
+            return False
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - self.refresh_margin <= now
+
+    def refresh_if_needed(self, credentials, token_file_path):
+        if not credentials.refresh_token or not self.needs_refresh(credentials):
+            return credentials
+
+        with self._lock(token_file_path):
+            # Another thread may have refreshed while we waited for the lock
+            cached = self._cache.get(token_file_path)
+            if cached is not None and not self.needs_refresh(cached):
+                return cached
+
+            with self._file_lock(token_file_path):
+                # ...or another process, in which case its token is on disk
+                if os.path.exists(token_file_path):
+                    on_disk = Credentials.from_authorized_user_file(token_file_path, credentials.scopes)
+                    if on_disk.token != credentials.token and not self.needs_refresh(on_disk):
+                        self._cache[token_file_path] = on_disk
+                        return on_disk
+
+                credentials.refresh(Request())
+                self._write_atomic(credentials, token_file_path)
+                self._cache[token_file_path] = credentials
+
+        print(f"Credentials refreshed, token saved to {token_file_path}")
+        return credentials
+
+    def _lock(self, token_file_path):
+        with self._locks_lock:
+            return self._locks.setdefault(token_file_path, threading.RLock())
+
+    def _file_lock(self, token_file_path):
+        # Without fcntl (Windows), only in-process locking applies
+        return file_lock(f"{token_file_path}.lock")
+
+    def _write_atomic(self, credentials, token_file_path):
+        write_atomic(token_file_path, credentials.to_json())
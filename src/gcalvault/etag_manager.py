@@ -1,34 +1,57 @@
 import os
 
+from .file_lock import write_atomic
+
+
+# Etags are kept per user, so the file is only written by syncs of that user,
+# which hold the user's conf dir lease (that doesn't rely on file locking, so
+# it holds across hosts). The file shared by all users, from before, seeds a
+# user's etags the first time.
+LEGACY_FILE_NAME = ".etags"
+
 
 class ETagManager():
 
-    def __init__(self, conf_dir):
-        self._etag_cache_file_path = os.path.join(conf_dir, ".etags")
+    def __init__(self, conf_dir, user):
+        self._etag_cache_file_path = os.path.join(conf_dir, f"{user}.etags")
+        self._legacy_file_path = os.path.join(conf_dir, LEGACY_FILE_NAME)
         self._cache = self._read_cache_file()
 
     def test_for_change_and_save(self, object_name, etag):
-        key = "_".join(object_name.strip().lower().split())
-        value = "_".join(etag.strip().strip('"').split())
-
-        if key in self._cache and self._cache[key] == value:
+        if not self.test_for_change(object_name, etag):
             return False
+        self.save(object_name, etag)
+        return True
 
+    def test_for_change(self, object_name, etag):
+        (key, value) = _normalize(object_name, etag)
+        return self._cache.get(key) != value
+
+    def save(self, object_name, etag):
+        (key, value) = _normalize(object_name, etag)
+        if self._cache.get(key) == value:
+            return
         self._cache[key] = value
         self._write_cache_file()
-        return True
 
     def _read_cache_file(self):
         cache = {}
-        if os.path.exists(self._etag_cache_file_path):
-            with open(self._etag_cache_file_path, 'r') as file:
+        file_path = self._etag_cache_file_path
+        if not os.path.exists(file_path):
+            file_path = self._legacy_file_path
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
                 for line in file:
                     (key, value) = line.split()
                     cache[key] = value
         return cache
 
     def _write_cache_file(self):
-        with open(self._etag_cache_file_path, 'w') as file:
-            for key in self._cache:
-                value = self._cache[key]
-                print(f"{key}\t{value}", file=file)
+        write_atomic(
+            self._etag_cache_file_path,
+            "".join(f"{key}\t{value}\n" for (key, value) in self._cache.items()),
+            fsync=False)  # Losing etags in a crash just means downloading again
+
+
+def _normalize(object_name, etag):
+    return ("_".join(object_name.strip().lower().split()), "_".join(etag.strip().strip('"').split()))
@@ -0,0 +1,78 @@
+import hashlib
+
+from .ical import iter_events
+
+
+# Properties that change on every export without the event itself changing
+VOLATILE_PROPERTIES = ('DTSTAMP:', 'DTSTAMP;')
+
+MAX_MESSAGE_EVENTS = 50
+
+
+class EventDiff():
+
+    def __init__(self, calendar_id):
+        self.calendar_id = calendar_id
+        self.added = []
+        self.modified = []
+        self.deleted = []
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.deleted)
+
+    def summary(self):
+        return (f"{len(self.added)} added, {len(self.modified)} modified, "
+                f"{len(self.deleted)} deleted event(s)")
+
+    def to_dict(self):
+        return {
+            'calendar_id': self.calendar_id,
+            'added': [_change_dict(change) for change in self.added],
+            'modified': [_change_dict(change) for change in self.modified],
+            'deleted': [_change_dict(change) for change in self.deleted],
+        }
+
+    def message_lines(self, max_events=MAX_MESSAGE_EVENTS):
+        lines = [f"{self.calendar_id}: {self.summary()}"]
+        changes = [('+', change) for change in self.added] + \
+            [('~', change) for change in self.modified] + \
+            [('-', change) for change in self.deleted]
+        for (marker, (uid, recurrence_id, summary)) in changes[:max_events]:
+            instance = f" ({recurrence_id})" if recurrence_id else ""
+            lines.append(f"  {marker} {uid}{instance} {summary}".rstrip())
+        if len(changes) > max_events:
+            lines.append(f"  ... and {len(changes) - max_events} more")
+        return lines
+
+
+def diff_events(calendar_id, old_source, new_source):
+    old_events = {}
+    if old_source is not None:
+        for event in iter_events(old_source):
+            old_events[event.key] = (event.sequence, _digest(event), event.summary)
+
+    diff = EventDiff(calendar_id)
+    for event in iter_events(new_source):
+        key = event.key
+        old = old_events.pop(key, None)
+        if old is None:
+            diff.added.append((key[0], key[1], event.summary))
+        elif old[0] != event.sequence or old[1] != _digest(event):
+            diff.modified.append((key[0], key[1], event.summary))
+    for (key, (_, _, summary)) in old_events.items():
+        diff.deleted.append((key[0], key[1], summary))
+    return diff
+
+
+def _digest(event):
+    digest = hashlib.sha1()
+    for line in event.lines:
+        if not line.startswith(VOLATILE_PROPERTIES):
+            digest.update(line.encode('utf-8'))
+            digest.update(b"\n")
+    return digest.digest()
+
+
+def _change_dict(change):
+    (uid, recurrence_id, summary) = change
+    return {'uid': uid, 'recurrence_id': recurrence_id or None, 'summary': summary}
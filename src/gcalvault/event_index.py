@@ -0,0 +1,118 @@
+import os
+import sqlite3
+
+from .ical import iter_events, unescape_text
+
+
+# Bumped when the schema changes; the index is then rebuilt from scratch (as
+# calendars are synced again), rather than migrated
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calendars (
+    user TEXT NOT NULL,
+    calendar_id TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    PRIMARY KEY (user, calendar_id)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    calendar_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    recurrence_id TEXT,
+    summary TEXT,
+    start TEXT,
+    end TEXT,
+    first_day TEXT,
+    last_day TEXT,
+    organizer TEXT
+);
+CREATE INDEX IF NOT EXISTS events_by_calendar ON events (user, calendar_id);
+CREATE INDEX IF NOT EXISTS events_by_day ON events (first_day, last_day);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5 (
+    summary, description, location, organizer, attendees
+);
+"""
+
+
+class EventIndex():
+
+    def __init__(self, conf_dir):
+        self._db = sqlite3.connect(os.path.join(conf_dir, "events.db"), timeout=60)
+        with self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._db.executescript(
+                    "DROP TABLE IF EXISTS calendars; DROP TABLE IF EXISTS events; DROP TABLE IF EXISTS events_fts;")
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def needs_update(self, user, calendar_id, etag):
+        row = self._db.execute(
+            "SELECT etag FROM calendars WHERE user = ? AND calendar_id = ?", (user, calendar_id)).fetchone()
+        return row is None or row[0] != etag
+
+    def update_calendar(self, user, calendar_id, etag, cal_file_path):
+        with self._db, open(cal_file_path, 'r') as file:
+            self._delete_events(user, calendar_id)
+            calendar_properties = {}
+            for event in iter_events(file, calendar_properties):
+                (start, _) = event.start
+                (end, _) = event.end
+                (first_day, last_day) = event.days(calendar_properties.get('X-WR-TIMEZONE'))
+                cursor = self._db.execute(
+                    "INSERT INTO events (user, calendar_id, uid, recurrence_id, summary, start, end, first_day, last_day, "
+                    "organizer) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user, calendar_id, event.uid, event.recurrence_id, event.summary,
+                        start, end, first_day, last_day, event.organizer))
+                self._db.execute(
+                    "INSERT INTO events_fts (rowid, summary, description, location, organizer, attendees) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, event.summary, unescape_text(event.get('DESCRIPTION', '')),
+                        unescape_text(event.get('LOCATION', '')), event.organizer or '', " ".join(event.attendees)))
+            self._db.execute(
+                "INSERT OR REPLACE INTO calendars (user, calendar_id, etag) VALUES (?, ?, ?)",
+                (user, calendar_id, etag))
+
+    def remove_calendars_except(self, user, calendar_ids):
+        with self._db:
+            rows = self._db.execute("SELECT calendar_id FROM calendars WHERE user = ?", (user,)).fetchall()
+            for (calendar_id,) in rows:
+                if calendar_id not in calendar_ids:
+                    self._delete_events(user, calendar_id)
+                    self._db.execute(
+                        "DELETE FROM calendars WHERE user = ? AND calendar_id = ?", (user, calendar_id))
+
+    def search(self, user=None, text=None, on=None, calendar_ids=None):
+        # Searches all users' events if user is None. `on` is a date
+        # (YYYY-MM-DD), matched against the days events occupy in their own
+        # time zone.
+        sql = "SELECT e.start, e.end, e.calendar_id, e.uid, e.summary, e.organizer, e.user FROM events e"
+        where = []
+        args = []
+        if user:
+            where.append("e.user = ?")
+            args.append(user)
+        if text:
+            sql += " JOIN events_fts f ON f.rowid = e.id"
+            where.append("events_fts MATCH ?")
+            args.append(" ".join('"' + term.replace('"', '""') + '"' for term in text.split()))
+        if on:
+            where.append("e.first_day <= ? AND e.last_day >= ?")
+            args.extend([on, on])
+        if calendar_ids:
+            where.append(f"e.calendar_id IN ({', '.join('?' for _ in calendar_ids)})")
+            args.extend(calendar_ids)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY e.first_day, e.start, e.user, e.calendar_id, e.uid"
+        return self._db.execute(sql, args).fetchall()
+
+    def _delete_events(self, user, calendar_id):
+        self._db.execute(
+            "DELETE FROM events_fts WHERE rowid IN (SELECT id FROM events WHERE user = ? AND calendar_id = ?)",
+            (user, calendar_id))
+        self._db.execute("DELETE FROM events WHERE user = ? AND calendar_id = ?", (user, calendar_id))
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, fall back to no locking
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(lock_file_path):
+    if fcntl is None:
+        yield
+        return
+    with open(lock_file_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_atomic(file_path, content, fsync=True):
+    dir_path = os.path.dirname(os.path.abspath(file_path))
+    (fd, temp_file_path) = tempfile.mkstemp(dir=dir_path, prefix=f".{os.path.basename(file_path)}.")
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        os.remove(temp_file_path)
+        raise
@@ -1,15 +1,45 @@
 import os
+import sys
+import time
+import json
+import asyncio
+import secrets
+import re
+import hashlib
 import glob
+import weakref
+import contextlib
+import contextvars
+import multiprocessing
 import requests
 import urllib.parse
 import pathlib
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from getopt import gnu_getopt, GetoptError
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from git import exc
 from dotenv import load_dotenv
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 from .google_oauth2 import GoogleOAuth2
-from .git_vault_repo import GitVaultRepo
+from .git_vault_repo import GitVaultRepo, FastImportGitVaultRepo, DeferredGitVaultRepo, replay_deferred_commit
 from .etag_manager import ETagManager
+from .hash_manager import HashManager, hash_blob, hash_file
+from .history_index import HistoryIndex
+from .event_index import EventIndex
+from .event_diff import diff_events
+from .poll_schedule import PollSchedule
+from .push_notifications import NotificationReceiver, ChannelManager
+from .columnar_export import ColumnarExporter, FORMATS as EXPORT_FORMATS
+from .profiler import Profiler
+from .lease import Lease, LEASE_TTL
+from .caldav import calendar_query_body, iter_multistatus, merge_calendars, REPORT_HEADERS
 
 
 # Note: OAuth2 auth code flow for "installed applications" assumes the client secret
@@ -25,8 +55,31 @@ OAUTH_SCOPES = [
 ]
 
 GOOGLE_CALDAV_URI_FORMAT = "https://apidata.googleusercontent.com/caldav/v2/{cal_id}/events"
+GOOGLE_CAL_LIST_URI = "https://www.googleapis.com/calendar/v3/users/me/calendarList"
+
+COMMANDS = ['sync', 'watch', 'fleet', 'show', 'search', 'export', 'login', 'authorize', 'noop']
+
+# How often the watch loop wakes up to renew channels when idle
+WATCH_POLL_INTERVAL = 60
+
+# Values of the GCALVAULT_PROFILE env var that enable --profile ('memory'
+# also enables --profile-memory)
+PROFILE_MODES = ['1', 'true', 'cpu', 'memory']
+
+# Lease held on the vault (output dir) during a sync; the vault's .gitignore
+# keeps it out of version history
+VAULT_LEASE_FILE_NAME = ".gcalvault.lease"
+
+GIT_ENGINES = {
+    'index': GitVaultRepo,
+    'fast-import': FastImportGitVaultRepo,
+}
 
-COMMANDS = ['sync', 'login', 'authorize', 'noop']
+# Vault work (git, hashing, diffing) of async syncs runs on this one thread:
+# off the event loop, so it doesn't hold up other users' downloads, but never
+# concurrently, as GitPython changes the process' working directory during
+# index operations
+_vault_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gcalvault-vault")
 
 load_dotenv()
 
@@ -37,63 +90,231 @@ version_file_path = os.path.join(dirname, "VERSION.txt")
 
 class Gcalvault:
 
-    def __init__(self, google_oauth2=None, google_apis=None):
+    def __init__(self, google_oauth2=None, google_apis=None, async_google_apis=None):
         self.command = None
         self.user = None
         self.includes = []
         self.export_only = False
         self.clean = False
         self.ignore_roles = []
+        self.git_engine = 'index'
+        self.at = None
+        self.index = False
+        self.query = None
+        self.on = None
+        self.changes_file = None
+        self.use_async = False
+        self.concurrency = 8
+        self.adaptive = False
+        self.full = False
+        self.webhook_url = None
+        self.listen = "0.0.0.0:8080"
+        self.since = None
+        self.until = None
+        self.export_dir = None
+        self.export_format = 'parquet'
+        profile_mode = os.getenv("GCALVAULT_PROFILE", "").strip().lower()
+        self.profile = profile_mode in PROFILE_MODES
+        self.profile_memory = profile_mode == 'memory'
+        self.shard = os.getenv("GCALVAULT_SHARD")
+        self.users_file = None
+        self.processes = os.cpu_count() or 1
+        self.lease_ttl = LEASE_TTL
         self.conf_dir = os.getenv("GCALVAULT_CONF_DIR", os.path.expanduser("~/.gcalvault"))
         self.output_dir = os.getenv("GCALVAULT_OUTPUT_DIR", os.path.join(os.getcwd(), 'gcalvault'))
         self.client_id = DEFAULT_CLIENT_ID
         self.client_secret = DEFAULT_CLIENT_SECRET
 
         self._repo = None
+        self._event_diffs = []
+        self._schedule = None
+        self._hashes = None
+        self._invalid_files = set()
+        self._failed_calendars = []
+        self._calendars = []
+        self._profiler = Profiler()
+        self._leases = []
+        self._vault_submit_fn = None
         self._google_oauth2 = google_oauth2 if google_oauth2 is not None else GoogleOAuth2(
             app_name="gcalvault",
             authorize_command_fn=self._authorize_command,
         )
         self._google_apis = google_apis if google_apis is not None else GoogleApis()
+        self._async_google_apis = async_google_apis
 
     def run(self, cli_args):
         if not self._parse_options(cli_args):
             return
         getattr(self, self.command)()
 
+    async def run_async(self, cli_args):
+        if not self._parse_options(cli_args):
+            return
+        if self.command == 'sync':
+            await self.sync_async()
+        else:
+            await asyncio.to_thread(getattr(self, self.command))
+
     def noop(self):
         self._ensure_dirs()
         pass
 
     def sync(self):
-        self._ensure_dirs()
+        if not self._in_shard():
+            return
+        if self.use_async:
+            asyncio.run(self.sync_async())
+            return
 
-        (credentials, _) = self._google_oauth2.get_credentials(
-            self._token_file_path(), self.client_id, self.client_secret, OAUTH_SCOPES, self.user)
+        with self._profiling(), self._leased():
+            if not self._any_calendars_due():
+                return
 
-        if not self.export_only:
-            self._repo = GitVaultRepo("gcalvault", self.version(), self.output_dir, [".ics"])
+            credentials = self._get_credentials()
+            self._begin_sync()
+            calendars = self._select_calendars(self._get_calendars(credentials))
+            self._dl_and_save_calendars(calendars, credentials)
+            self._end_sync(calendars)
 
-        calendars = self._get_calendars(credentials)
+    async def sync_async(self):
+        if not self._in_shard():
+            return
+        owns_google_apis = self._async_google_apis is None
+        if owns_google_apis:
+            self._async_google_apis = AsyncGoogleApis()
+        try:
+            with self._profiling(), self._leased():
+                if not self._any_calendars_due():
+                    return
 
-        if self.ignore_roles:
-            calendars = [cal for cal in calendars if cal.access_role not in self.ignore_roles]
+                # Getting credentials may mean authorizing interactively
+                credentials = await asyncio.to_thread(self._get_credentials)
+                await self._in_vault_thread(self._begin_sync)
+                calendars = await self._get_calendars_async(credentials)
+                calendars = await self._in_vault_thread(self._select_calendars, calendars)
+                await self._dl_and_save_calendars_async(calendars, credentials)
+                await self._end_sync_async(calendars)
+        finally:
+            if owns_google_apis:
+                await self._async_google_apis.aclose()
+                self._async_google_apis = None
 
-        if self.includes:
-            calendars = [cal for cal in calendars if cal.id in self.includes]
+    def watch(self):
+        if not self.webhook_url:
+            raise GcalvaultError("--webhook-url option is required for 'watch'")
+        if not self._in_shard():
+            return
+        (host, _, port) = self.listen.rpartition(':')
+        try:
+            receiver = NotificationReceiver(host or "0.0.0.0", int(port), secrets.token_urlsafe(32))
+        except (ValueError, OSError) as e:
+            raise GcalvaultError(f"Cannot listen on '{self.listen}': {e}") from e
 
-        cal_ids = [cal.id for cal in calendars]
-        for include in self.includes:
-            if include not in cal_ids:
-                raise GcalvaultError(f"Specified calendar '{include}' was not found")
+        receiver.start()
+        print(f"Listening for push notifications on port {receiver.port}")
+        try:
+            self._watch(receiver)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            receiver.stop()
 
-        if self.clean:
-            self._clean_output_dir(calendars)
+    def fleet(self):
+        users = self._fleet_users()
+        print(f"Syncing {len(users)} user(s), downloading for {self.concurrency} at a time and "
+              f"committing to vaults with {self.processes} process(es)")
 
-        self._dl_and_save_calendars(calendars, credentials)
+        # Spawned rather than forked, as forking a process with threads running
+        # (downloads are in progress while the pool starts) isn't safe
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=mp_context) as processes, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as threads:
+            results = list(threads.map(lambda user: self._sync_fleet_user(user, processes), users))
 
-        if self._repo:
-            self._repo.commit("gcalvault sync")
+        print("")
+        print("Results:")
+        failed = 0
+        for (user, (error, elapsed)) in zip(users, results):
+            print(f"  {user}: {'FAILED, ' + error if error else 'OK'} ({elapsed:.1f}s)")
+            if error:
+                failed += 1
+        if failed:
+            raise GcalvaultError(f"Sync failed for {failed} of {len(users)} user(s)")
+
+    def show(self):
+        if len(self.includes) != 1:
+            raise GcalvaultError("Exactly one <cal-id> argument is required")
+        file_name = Calendar(self.includes[0], None, None, None, self._window_label()).file_name
+
+        try:
+            history = HistoryIndex(self.output_dir)
+        except (exc.NoSuchPathError, exc.InvalidGitRepositoryError) as e:
+            raise GcalvaultError(f"No vault found in '{self.output_dir}'") from e
+
+        timestamp = _parse_timestamp(self.at) if self.at else None
+        try:
+            if timestamp is not None:
+                blob_sha = history.find_blob_at_time(file_name, timestamp)
+            else:
+                blob_sha = history.find_blob_at_commit(file_name, self.at or 'HEAD')
+        except ValueError as e:
+            raise GcalvaultError(e) from e
+        if blob_sha is None:
+            raise GcalvaultError(f"Calendar '{self.includes[0]}' was not in the vault at '{self.at or 'HEAD'}'")
+
+        history.stream_blob(blob_sha, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+
+    def search(self):
+        if not self.query and not self.on:
+            raise GcalvaultError("At least one of --query or --on is required")
+        if not os.path.exists(os.path.join(self.conf_dir, "events.db")):
+            raise GcalvaultError(f"No event index found in '{self.conf_dir}', run 'sync' with --index first")
+
+        index = EventIndex(self.conf_dir)
+        try:
+            for (start, end, calendar_id, uid, summary, _, user) in index.search(
+                    self.user, self.query, self.on, self.includes):
+                columns = [start or '', end or '', calendar_id, uid, summary or '']
+                # Without a <user>, all users' events are searched, so say whose each is
+                print("\t".join(columns if self.user else [user] + columns))
+        finally:
+            index.close()
+
+    def export(self):
+        if not self.export_dir:
+            raise GcalvaultError("--export-dir option is required for 'export'")
+        try:
+            exporter = ColumnarExporter(self.export_dir, self.user, self.export_format)
+        except RuntimeError as e:
+            raise GcalvaultError(e) from e
+
+        window = self._window_label()
+        if self.includes:
+            file_names = [Calendar(include, None, None, None, window).file_name for include in self.includes]
+        else:
+            # Only files of the same window (or of full exports, without one),
+            # so that each calendar is exported once
+            file_names = sorted(
+                file_name for file_name in
+                (os.path.basename(file) for file in glob.glob(os.path.join(self.output_dir, "*.ics")))
+                if _window_label_of(file_name) == window)
+
+        for file_name in file_names:
+            cal_file_path = os.path.join(self.output_dir, file_name)
+            if not os.path.exists(cal_file_path):
+                raise GcalvaultError(f"Calendar file '{file_name}' was not found in '{self.output_dir}'")
+            calendar_id = _calendar_id_of(file_name)
+            event_count = exporter.export_calendar(calendar_id, cal_file_path)
+            if event_count is None:
+                print(f"Calendar '{calendar_id}' is up to date")
+            else:
+                print(f"Exported {event_count} event(s) from calendar '{calendar_id}'")
+
+        if not self.includes:
+            for calendar_id in exporter.remove_calendars_except([_calendar_id_of(file_name) for file_name in file_names]):
+                print(f"Removed export of calendar '{calendar_id}'")
+        exporter.save_state()
 
     def login(self):
         self._ensure_dirs()
@@ -118,7 +339,12 @@ class Gcalvault:
             (opts, pos_args) = gnu_getopt(
                 cli_args,
                 'efi:c:o:h',
-                ['export-only', 'clean', 'ignore-role=',
+                ['export-only', 'clean', 'ignore-role=', 'git-engine=', 'at=',
+                    'index', 'query=', 'on=', 'changes-file=', 'async', 'concurrency=',
+                    'adaptive', 'full',
+                    'webhook-url=', 'listen=', 'since=', 'until=',
+                    'export-dir=', 'format=', 'profile', 'profile-memory', 'shard=',
+                    'users-file=', 'processes=',
                     'conf-dir=', 'output-dir=', 'vault-dir=',
                     'client-id=', 'client-secret=',
                     'help', 'version', ]
@@ -133,6 +359,54 @@ class Gcalvault:
                 self.clean = True
             elif opt in ['-i', '--ignore-role']:
                 self.ignore_roles.append(val.lower())
+            elif opt in ['--git-engine']:
+                self.git_engine = val.lower()
+            elif opt in ['--at']:
+                self.at = val.strip()
+            elif opt in ['--index']:
+                self.index = True
+            elif opt in ['--query']:
+                self.query = val
+            elif opt in ['--on']:
+                self.on = val.strip()
+            elif opt in ['--changes-file']:
+                self.changes_file = val
+            elif opt in ['--async']:
+                self.use_async = True
+            elif opt in ['--adaptive']:
+                self.adaptive = True
+            elif opt in ['--full']:
+                self.full = True
+            elif opt in ['--webhook-url']:
+                self.webhook_url = val
+            elif opt in ['--listen']:
+                self.listen = val
+            elif opt in ['--since']:
+                self.since = val.strip().lower()
+            elif opt in ['--until']:
+                self.until = val.strip().lower()
+            elif opt in ['--export-dir']:
+                self.export_dir = val
+            elif opt in ['--format']:
+                self.export_format = val.lower()
+            elif opt in ['--profile']:
+                self.profile = True
+            elif opt in ['--profile-memory']:
+                self.profile = self.profile_memory = True
+            elif opt in ['--shard']:
+                self.shard = val
+            elif opt in ['--users-file']:
+                self.users_file = val
+            elif opt in ['--concurrency']:
+                try:
+                    self.concurrency = int(val)
+                except ValueError as e:
+                    raise GcalvaultError("Invalid --concurrency option") from e
+            elif opt in ['--processes']:
+                try:
+                    self.processes = int(val)
+                except ValueError as e:
+                    raise GcalvaultError("Invalid --processes option") from e
             elif opt in ['-c', '--conf-dir']:
                 self.conf_dir = val
             elif opt in ['-o', '--output-dir', '--vault-dir']:
@@ -167,8 +441,30 @@ class Gcalvault:
             raise GcalvaultError("<command> argument is required")
         if self.command not in COMMANDS:
             raise GcalvaultError("Invalid <command> argument")
-        if self.user is None:
+        if self.user is None and self.command != 'search' and not (self.command == 'fleet' and self.users_file):
             raise GcalvaultError("<user> argument is required")
+        if self.git_engine not in GIT_ENGINES:
+            raise GcalvaultError("Invalid --git-engine option")
+        if self.concurrency < 1:
+            raise GcalvaultError("Invalid --concurrency option")
+        if self.processes < 1:
+            raise GcalvaultError("Invalid --processes option")
+        if self.export_format not in EXPORT_FORMATS:
+            raise GcalvaultError("Invalid --format option")
+        if self.shard is not None:
+            self.shard = _parse_shard(self.shard)
+            if self.shard is None:
+                raise GcalvaultError("Invalid --shard option")
+        if self.on is not None and _parse_date(self.on) is None:
+            raise GcalvaultError("Invalid --on option")
+        for (opt, val) in [('--since', self.since), ('--until', self.until)]:
+            if val is not None and _parse_window_bound(val) is None:
+                raise GcalvaultError(f"Invalid {opt} option")
+
+        # Absolute, as GitPython changes the working directory during index
+        # operations, which may run in another thread (see _vault_executor)
+        self.conf_dir = os.path.abspath(self.conf_dir)
+        self.output_dir = os.path.abspath(self.output_dir)
 
         return True
 
@@ -176,6 +472,88 @@ class Gcalvault:
         for dir in [self.conf_dir, self.output_dir]:
             pathlib.Path(dir).mkdir(parents=True, exist_ok=True)
     
+    def _profiling(self):
+        if not self.profile:
+            return contextlib.nullcontext()
+        profiles_dir = os.path.join(self.conf_dir, "profiles")
+        pathlib.Path(profiles_dir).mkdir(parents=True, exist_ok=True)
+        path_prefix = os.path.join(profiles_dir, f"{self.user}-sync-{datetime.now():%Y%m%d-%H%M%S-%f}")
+        return self._profiler.profile(path_prefix, 'sync', memory=self.profile_memory)
+
+    def _fleet_users(self):
+        users = [self.user] if self.user else []
+        users += self.includes
+        if self.users_file:
+            try:
+                with open(self.users_file, 'r') as file:
+                    users += [line.strip().lower() for line in file if line.strip() and not line.startswith('#')]
+            except OSError as e:
+                raise GcalvaultError(f"Cannot read --users-file: {e}") from e
+        users = list(dict.fromkeys(users))
+        if self.shard is not None:
+            (index, count) = self.shard
+            users = [user for user in users if _shard_of(user, count) == index]
+        return users
+
+    def _sync_fleet_user(self, user, processes):
+        gc = Gcalvault(self._google_oauth2, self._google_apis, self._async_google_apis)
+        for (name, value) in vars(self).items():
+            if not name.startswith('_'):
+                setattr(gc, name, list(value) if isinstance(value, list) else value)
+        (gc.command, gc.user, gc.includes, gc.shard) = ('sync', user, [], None)
+        gc.output_dir = os.path.join(self.output_dir, user)
+        gc._vault_submit_fn = lambda job: processes.submit(replay_deferred_commit, job)
+
+        start = time.perf_counter()
+        try:
+            # Never prompt for authorization, with many users syncing unattended
+            if not os.path.exists(gc._token_file_path()):
+                raise GcalvaultError(f"No access token in '{gc.conf_dir}', run 'gcalvault login {user}' first")
+            gc.sync()
+            error = None
+        except Exception as e:
+            error = str(e) if isinstance(e, GcalvaultError) else f"{type(e).__name__}: {e}"
+            print(f"Sync of '{user}' failed: {error}")
+        return (error, time.perf_counter() - start)
+
+    def _in_shard(self):
+        if self.shard is None:
+            return True
+        (index, count) = self.shard
+        user_index = _shard_of(self.user, count)
+        if user_index != index:
+            print(f"User '{self.user}' is assigned to shard {user_index}/{count}, skipping")
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def _leased(self):
+        self._ensure_dirs()
+        lease_file_paths = [
+            os.path.join(self.output_dir, VAULT_LEASE_FILE_NAME),
+            os.path.join(self.conf_dir, f"{self.user}.lease"),
+        ]
+        try:
+            for lease_file_path in lease_file_paths:
+                lease = Lease(lease_file_path, self.lease_ttl)
+                if not lease.acquire():
+                    holder = lease.holder() or {'owner': "unknown", 'expires': time.time()}
+                    raise GcalvaultError(
+                        f"Another sync of '{self.user}' is in progress: '{lease_file_path}' is leased "
+                        f"by {holder['owner']} until {datetime.fromtimestamp(holder['expires']):%Y-%m-%d %H:%M:%S}")
+                self._leases.append(lease)
+            yield
+        finally:
+            for lease in self._leases:
+                lease.release()
+            self._leases = []
+
+    def _verify_leases(self):
+        for lease in self._leases:
+            if not lease.verify():
+                raise GcalvaultError(
+                    f"Lease '{lease.file_path}' was taken over by another worker, aborting sync of '{self.user}'")
+
     def _token_file_path(self):
         return os.path.join(self.conf_dir, f"{self.user}.token.json")
 
@@ -185,46 +563,465 @@ class Gcalvault:
             flags = f' --client-id "{client_id}" --client-secret "{client_secret}"'
         return f"gcalvault authorize {email_addr}{flags}"
 
+    def _watch(self, receiver):
+        self.full = True
+        self.sync()
+        cal_ids = [cal.id for cal in self._calendars]
+
+        # Failures (e.g. network errors) are logged and retried, rather than
+        # ending the watch
+        channels = ChannelManager(self._google_apis, self.webhook_url, receiver.token)
+        targets = set()
+        try:
+            while receiver.running:
+                try:
+                    channels.ensure_channels(cal_ids, self._get_credentials())
+                except Exception as e:
+                    print(f"WARNING: Cannot renew channels: {type(e).__name__}: {e}")
+
+                next_renewal = channels.next_renewal()
+                timeout = WATCH_POLL_INTERVAL if next_renewal is None else \
+                    min(WATCH_POLL_INTERVAL, max(0, next_renewal - time.time()))
+                for channel_id in receiver.wait(timeout):
+                    (known, cal_id) = channels.resolve(channel_id)
+                    if known:
+                        targets.add(cal_id)
+                if not targets or not receiver.running:
+                    continue
+
+                # A change to the calendar list (None) calls for a full sync,
+                # otherwise only the calendars that were notified are synced
+                full_sync = None in targets
+                try:
+                    self._watch_sync(None if full_sync else sorted(targets))
+                except Exception as e:
+                    # Retried (as a full sync, in case a notified calendar is
+                    # gone) on the next pass
+                    print(f"Sync failed, retrying in {WATCH_POLL_INTERVAL}s: {type(e).__name__}: {e}")
+                    targets = {None}
+                    continue
+                targets = set()
+                if full_sync:
+                    cal_ids = [cal.id for cal in self._calendars]
+        finally:
+            try:
+                channels.stop_all(self._get_credentials())
+            except Exception as e:
+                print(f"WARNING: Cannot stop channels: {type(e).__name__}: {e}")
+
+    def _watch_sync(self, cal_ids):
+        # cal_ids None for a full sync. A sync of just the notified calendars
+        # mustn't --clean, which would remove all of the other calendars
+        (includes, clean) = (self.includes, self.clean)
+        if cal_ids is not None:
+            (self.includes, self.clean) = (cal_ids, False)
+        try:
+            self.sync()
+        finally:
+            (self.includes, self.clean) = (includes, clean)
+
+    async def _in_vault_thread(self, fn, *args):
+        context = contextvars.copy_context()  # For profiler phases
+        return await asyncio.get_running_loop().run_in_executor(_vault_executor, context.run, fn, *args)
+
+    def _get_credentials(self):
+        (credentials, _) = self._google_oauth2.get_credentials(
+            self._token_file_path(), self.client_id, self.client_secret, OAUTH_SCOPES, self.user)
+        return credentials
+
+    def _begin_sync(self):
+        self._ensure_dirs()
+        self._event_diffs = []
+        self._failed_calendars = []
+        self._hashes = HashManager(self.conf_dir, self.user)
+        self._invalid_files = set()
+
+        if not self.export_only:
+            with self._profiler.phase('git'):
+                if self._vault_submit_fn is not None:
+                    self._repo = DeferredGitVaultRepo(
+                        GIT_ENGINES[self.git_engine], "gcalvault", self.version(), self.output_dir, [".ics"],
+                        self._vault_submit_fn)
+                else:
+                    self._repo = GIT_ENGINES[self.git_engine]("gcalvault", self.version(), self.output_dir, [".ics"])
+
+    def _select_calendars(self, calendars):
+        if self.ignore_roles:
+            calendars = [cal for cal in calendars if cal.access_role not in self.ignore_roles]
+
+        if self.includes:
+            calendars = [cal for cal in calendars if cal.id in self.includes]
+
+        cal_ids = [cal.id for cal in calendars]
+        for include in self.includes:
+            if include not in cal_ids:
+                raise GcalvaultError(f"Specified calendar '{include}' was not found")
+
+        self._calendars = calendars
+
+        if self.clean:
+            self._clean_output_dir(calendars)
+            if self.index:
+                self._clean_index(calendars)
+
+        return self._record_checks(calendars)
+
+    def _any_calendars_due(self):
+        self._schedule = PollSchedule(self.conf_dir, self.user)
+        if self.adaptive and not self.full and not self._schedule.any_due():
+            print("No calendars are due to be checked, skipping sync (use --full to force)")
+            return False
+        return True
+
+    def _record_checks(self, calendars):
+        # The schedule only decides whether to sync (and fetch the calendar
+        # list) at all. Once the list is fetched, any calendar whose etag it
+        # shows changed is downloaded, due or not. A calendar that isn't due
+        # and didn't change keeps its schedule, rather than backing off faster
+        # for being checked early.
+        for calendar in calendars:
+            if self._schedule.is_due(calendar.id) or self._schedule.has_changed(calendar.id, calendar.etag):
+                self._schedule.record_check(calendar.id, calendar.etag)
+        return calendars
+
+    def _end_sync(self, calendars):
+        self._save_sync_state(calendars)
+        if self._repo:
+            with self._profiler.phase('git'):
+                self._repo.commit(self._commit_message())
+        self._raise_failed_calendars()
+
+    async def _end_sync_async(self, calendars):
+        if not isinstance(self._repo, DeferredGitVaultRepo):
+            await self._in_vault_thread(self._end_sync, calendars)
+            return
+        # With fleet, the commit is replayed in a worker process. It's waited
+        # for here rather than on the vault thread, so that the vaults of users
+        # synced at the same time are committed in parallel.
+        await self._in_vault_thread(self._save_sync_state, calendars)
+        with self._profiler.phase('git'):
+            output = await asyncio.wrap_future(self._repo.submit_commit(self._commit_message()))
+        print(output, end="")
+        self._raise_failed_calendars()
+
+    def _save_sync_state(self, calendars):
+        self._verify_leases()
+        self._schedule.save()
+        self._hashes.save()
+
+        if self.index:
+            with self._profiler.phase('index'):
+                # Failed calendars' files are not of their listed etag
+                self._index_calendars([cal for cal in calendars if cal not in self._failed_calendars])
+
+        if self.changes_file:
+            self._write_changes_file()
+
+    def _raise_failed_calendars(self):
+        # Raised only after committing, so that the calendars that were saved
+        # are committed
+        if self._failed_calendars:
+            cal_names = ", ".join(f"'{cal.name}'" for cal in self._failed_calendars)
+            raise GcalvaultError(
+                f"Failed to sync {len(self._failed_calendars)} calendar(s), "
+                f"they will be downloaded again by the next sync: {cal_names}")
+
     def _get_calendars(self, credentials):
+        with self._profiler.phase('download'):
+            calendar_list = self._google_apis.request_cal_list(credentials)
+        return self._to_calendars(calendar_list)
+
+    async def _get_calendars_async(self, credentials):
+        with self._profiler.phase('download'):
+            calendar_list = await self._async_google_apis.request_cal_list(credentials)
+        return self._to_calendars(calendar_list)
+
+    def _to_calendars(self, calendar_list):
         calendars = []
-        calendar_list = self._google_apis.request_cal_list(credentials)
         for item in calendar_list['items']:
             calendars.append(
-                Calendar(item['id'], item['summary'], item['etag'], item['accessRole']))
+                Calendar(item['id'], item['summary'], item['etag'], item['accessRole'], self._window_label()))
+        self._schedule.record_calendar_list([cal.id for cal in calendars])
         return calendars
 
     def _clean_output_dir(self, calendars):
         cal_file_names = [cal.file_name for cal in calendars]
-        file_names_on_disk = [os.path.basename(file).lower() for file in glob.glob(os.path.join(self.output_dir, "*.ics"))]
+        # Only files of the same window (or of full exports, without one) are
+        # cleaned, so full exports and archived windows are kept
+        window = self._window_label()
+        file_names_on_disk = [
+            file_name for file_name in
+            (os.path.basename(file).lower() for file in glob.glob(os.path.join(self.output_dir, "*.ics")))
+            if _window_label_of(file_name) == window]
         for file_name_on_disk in file_names_on_disk:
             if file_name_on_disk not in cal_file_names:
+                if self._tracks_event_diffs():
+                    self._record_event_diff(file_name_on_disk[:-len(".ics")], os.path.join(self.output_dir, file_name_on_disk), "")
                 os.remove(os.path.join(self.output_dir, file_name_on_disk))
+                self._hashes.remove(file_name_on_disk)
                 if self._repo:
-                    self._repo.remove_file(file_name_on_disk)
+                    with self._profiler.phase('git'):
+                        self._repo.remove_file(file_name_on_disk)
                 print(f"Removed file '{file_name_on_disk}'")
+        self._verify_files(cal_file_names)
+
+    def _verify_files(self, file_names):
+        for file_name in file_names:
+            if not os.path.exists(os.path.join(self.output_dir, file_name)):
+                continue
+            valid = self._hashes.verify(self.output_dir, file_name)
+            if valid is None:
+                self._hashes.record(self.output_dir, file_name, hash_file(os.path.join(self.output_dir, file_name)))
+            elif not valid:
+                print(f"WARNING: File '{file_name}' does not match its last synced content, downloading it again")
+                self._invalid_files.add(file_name)
+
+    def _index_calendars(self, calendars):
+        index = EventIndex(self.conf_dir)
+        try:
+            for calendar in calendars:
+                cal_file_path = os.path.join(self.output_dir, calendar.file_name)
+                if os.path.exists(cal_file_path) and index.needs_update(self.user, calendar.id, calendar.etag):
+                    index.update_calendar(self.user, calendar.id, calendar.etag, cal_file_path)
+                    print(f"Indexed calendar '{calendar.name}'")
+        finally:
+            index.close()
+
+    def _clean_index(self, calendars):
+        index = EventIndex(self.conf_dir)
+        try:
+            index.remove_calendars_except(self.user, [cal.id for cal in calendars])
+        finally:
+            index.close()
 
     def _dl_and_save_calendars(self, calendars, credentials):
-        etags = ETagManager(self.conf_dir)
+        etags = ETagManager(self.conf_dir, self.user)
         for calendar in calendars:
-            self._dl_and_save_calendar(calendar, credentials, etags)
+            try:
+                credentials = self._google_oauth2.refresh_if_needed(credentials, self._token_file_path())
+                self._dl_and_save_calendar(calendar, credentials, etags)
+            except Exception as e:
+                self._record_failure(calendar, e)
 
     def _dl_and_save_calendar(self, calendar, credentials, etags):
+        if not self._needs_download(calendar, etags):
+            return
+
+        window_digest = None
+        with self._profiler.phase('download'):
+            if calendar.window:
+                (time_min, time_max) = self._window()
+                event_etags = self._google_apis.request_cal_etags(calendar.id, credentials, time_min, time_max)
+                window_digest = self._changed_window_digest(calendar, event_etags, etags)
+                if window_digest is None:
+                    self._save_etags(calendar, etags)
+                    return
+                print(f"Downloading calendar '{calendar.name}' ({calendar.window})")
+                ical = self._google_apis.request_cal_as_ical(calendar.id, credentials, time_min, time_max)
+            else:
+                print(f"Downloading calendar '{calendar.name}'")
+                ical = self._google_apis.request_cal_as_ical(calendar.id, credentials)
+        self._save_calendar(calendar, ical)
+        self._save_etags(calendar, etags, window_digest)
+
+    async def _dl_and_save_calendars_async(self, calendars, credentials):
+        etags = ETagManager(self.conf_dir, self.user)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def dl_and_save_calendar(calendar):
+            if not self._needs_download(calendar, etags):
+                return
+            window_digest = None
+            async with semaphore:
+                with self._profiler.phase('download'):
+                    fresh_credentials = await asyncio.to_thread(
+                        self._google_oauth2.refresh_if_needed, credentials, self._token_file_path())
+                    if calendar.window:
+                        (time_min, time_max) = self._window()
+                        event_etags = await self._async_google_apis.request_cal_etags(
+                            calendar.id, fresh_credentials, time_min, time_max)
+                        window_digest = self._changed_window_digest(calendar, event_etags, etags)
+                        if window_digest is None:
+                            self._save_etags(calendar, etags)
+                            return
+                        print(f"Downloading calendar '{calendar.name}' ({calendar.window})")
+                        ical = await self._async_google_apis.request_cal_as_ical(
+                            calendar.id, fresh_credentials, time_min, time_max)
+                    else:
+                        print(f"Downloading calendar '{calendar.name}'")
+                        ical = await self._async_google_apis.request_cal_as_ical(calendar.id, fresh_credentials)
+            await self._in_vault_thread(self._save_calendar, calendar, ical)
+            self._save_etags(calendar, etags, window_digest)
+
+        results = await asyncio.gather(
+            *[dl_and_save_calendar(calendar) for calendar in calendars], return_exceptions=True)
+        for (calendar, result) in zip(calendars, results):
+            if isinstance(result, Exception):
+                self._record_failure(calendar, result)
+            elif isinstance(result, BaseException):  # e.g. cancelled
+                raise result
+
+    def _record_failure(self, calendar, e):
+        # Its etag isn't saved, so the calendar is downloaded again next time
+        print(f"Failed to sync calendar '{calendar.name}': {type(e).__name__}: {e}")
+        self._failed_calendars.append(calendar)
+
+    def _needs_download(self, calendar, etags):
         cal_file_path = os.path.join(self.output_dir, calendar.file_name)
 
-        etag_changed = etags.test_for_change_and_save(calendar.id, calendar.etag)
-        if os.path.exists(cal_file_path) and not etag_changed:
+        etag_changed = etags.test_for_change(calendar.etag_key, calendar.etag)
+        if os.path.exists(cal_file_path) and not etag_changed and calendar.file_name not in self._invalid_files:
             print(f"Calendar '{calendar.name}' is up to date")
-            return
+            return False
+        return True
 
-        print(f"Downloading calendar '{calendar.name}'")
-        ical = self._google_apis.request_cal_as_ical(calendar.id, credentials)
+    def _changed_window_digest(self, calendar, event_etags, etags):
+        # The calendar's etag changes with any event, so for a windowed export
+        # the etags of just the events within the window are compared as well.
+        # Returns None if the window is up to date, otherwise its new digest
+        # (saved along with the etag, once the calendar is).
+        digest = hashlib.sha1()
+        for (href, etag) in sorted(event_etags):
+            digest.update(f"{href} {etag}\n".encode('utf-8'))
+        window_changed = etags.test_for_change(f"{calendar.etag_key} events", digest.hexdigest())
+        if os.path.exists(os.path.join(self.output_dir, calendar.file_name)) and not window_changed:
+            print(f"Calendar '{calendar.name}' ({calendar.window}) is up to date")
+            return None
+        return digest.hexdigest()
 
-        with open(cal_file_path, 'w') as file:
-            file.write(ical)
-        print(f"Saved calendar '{calendar.id}'")
+    def _save_etags(self, calendar, etags, window_digest=None):
+        if window_digest is not None:
+            etags.save(f"{calendar.etag_key} events", window_digest)
+        etags.save(calendar.etag_key, calendar.etag)
 
-        if self._repo:
-            self._repo.add_file(calendar.file_name)
+    def _window(self):
+        return (_parse_window_bound(self.since), _parse_window_bound(self.until))
+
+    def _window_label(self):
+        if self.since and self.until:
+            return f"{self.since}-to-{self.until}"
+        if self.since:
+            return f"since-{self.since}"
+        if self.until:
+            return f"until-{self.until}"
+        return None
+
+    def _save_calendar(self, calendar, ical):
+        cal_file_path = os.path.join(self.output_dir, calendar.file_name)
+
+        with self._profiler.phase('write'):
+            content = ical.encode('utf-8')
+            blob_sha = hash_blob(content)
+            unchanged = self._existing_blob_sha(calendar.file_name) == blob_sha
+            if not unchanged:
+                if self._tracks_event_diffs():
+                    self._record_event_diff(calendar.id, cal_file_path, ical)
+                with open(cal_file_path, 'wb') as file:
+                    file.write(content)
+                self._hashes.record(self.output_dir, calendar.file_name, blob_sha)
+        if unchanged:
+            print(f"Calendar '{calendar.id}' is unchanged")
+        else:
+            print(f"Saved calendar '{calendar.id}'")
+
+        # Even if unchanged on disk, it may not have been committed (e.g. if the
+        # last sync was interrupted, or was with --export-only)
+        if self._repo and (not unchanged or self._repo.committed_blob_sha(calendar.file_name) != blob_sha):
+            with self._profiler.phase('git'):
+                self._repo.add_file(calendar.file_name, blob_sha)
+
+    def _existing_blob_sha(self, file_name):
+        if file_name in self._invalid_files:
+            return None
+        blob_sha = self._hashes.known_hash(self.output_dir, file_name)
+        file_path = os.path.join(self.output_dir, file_name)
+        if blob_sha is None and os.path.exists(file_path):
+            # Not written by a sync that recorded its hash, or modified since
+            blob_sha = hash_file(file_path)
+            self._hashes.record(self.output_dir, file_name, blob_sha)
+        return blob_sha
+
+    def _tracks_event_diffs(self):
+        return self._repo is not None or self.changes_file is not None
+
+    def _record_event_diff(self, calendar_id, cal_file_path, new_source):
+        if os.path.exists(cal_file_path):
+            with open(cal_file_path, 'r') as file:
+                diff = diff_events(calendar_id, file, new_source)
+        else:
+            diff = diff_events(calendar_id, None, new_source)
+        if diff:
+            print(f"Calendar '{calendar_id}' has {diff.summary()}")
+            self._event_diffs.append(diff)
+
+    def _commit_message(self):
+        lines = []
+        for diff in self._event_diffs:
+            lines.extend(diff.message_lines())
+        return "\n".join(["gcalvault sync", ""] + lines) if lines else "gcalvault sync"
+
+    def _write_changes_file(self):
+        with open(self.changes_file, 'w') as file:
+            json.dump({
+                'user': self.user,
+                'calendars': [diff.to_dict() for diff in self._event_diffs],
+            }, file, indent=2)
+            print(file=file)
+
+
+def _parse_timestamp(value):
+    try:
+        if re.match(r"^\d{4}-\d{2}-\d{2}$", value):
+            # A date alone means the end of that day (local time), so that a
+            # calendar as of a date includes the syncs made during that day
+            return int((datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)).timestamp()) - 1
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return None
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _parse_window_bound(value):
+    if value is None:
+        return None
+    match = re.match(r"^(\d+)([dwy])$", value)
+    if match:
+        days = int(match.group(1)) * {'d': 1, 'w': 7, 'y': 365}[match.group(2)]
+        return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _window_label_of(file_name):
+    # Calendar ids end with a domain, which never looks like a window label
+    match = re.match(r"^.+\.((?:since|until)-[^.]+|[^.]+-to-[^.]+)\.ics$", file_name)
+    return match.group(1) if match else None
+
+
+def _calendar_id_of(file_name):
+    window = _window_label_of(file_name)
+    return file_name[:-len(f".{window}.ics" if window else ".ics")]
+
+
+def _parse_shard(value):
+    match = re.match(r"^(\d+)/(\d+)$", value.strip())
+    if not match:
+        return None
+    (index, count) = (int(match.group(1)), int(match.group(2)))
+    return (index, count) if index < count else None
+
+
+def _shard_of(user, count):
+    # Stable across processes and hosts, unlike hash()
+    return int(hashlib.sha1(user.encode('utf-8')).hexdigest(), 16) % count
 
 
 class GcalvaultError(ValueError):
@@ -233,13 +1030,19 @@ class GcalvaultError(ValueError):
 
 class Calendar():
 
-    def __init__(self, id, name, etag, access_role):
+    def __init__(self, id, name, etag, access_role, window=None):
         self.id = id
         self.name = name
         self.etag = etag
         self.access_role = access_role
+        self.window = window
 
-        self.file_name = f"{self.id.strip().lower()}.ics"
+        if window:
+            self.file_name = f"{self.id.strip().lower()}.{window}.ics"
+            self.etag_key = f"{self.id} {window}"
+        else:
+            self.file_name = f"{self.id.strip().lower()}.ics"
+            self.etag_key = self.id
 
 
 class GoogleApis():
@@ -248,13 +1051,105 @@ class GoogleApis():
         with build('calendar', 'v3', credentials=credentials) as service:
             return service.calendarList().list().execute()
 
-    def request_cal_as_ical(self, cal_id, credentials):
+    def request_cal_as_ical(self, cal_id, credentials, time_min=None, time_max=None):
+        url = GOOGLE_CALDAV_URI_FORMAT.format(cal_id=urllib.parse.quote(cal_id))
+        if time_min is None and time_max is None:
+            return self._request_with_token(url, credentials).text
+        response = self._request_with_token(
+            url, credentials, method='REPORT', data=calendar_query_body(time_min, time_max), headers=REPORT_HEADERS)
+        return merge_calendars(data for (_, _, data) in iter_multistatus(response.content) if data)
+
+    def request_cal_etags(self, cal_id, credentials, time_min=None, time_max=None):
         url = GOOGLE_CALDAV_URI_FORMAT.format(cal_id=urllib.parse.quote(cal_id))
-        return self._request_with_token(url, credentials).text
+        response = self._request_with_token(
+            url, credentials, method='REPORT', data=calendar_query_body(time_min, time_max, with_data=False),
+            headers=REPORT_HEADERS)
+        return [(href, etag) for (href, etag, _) in iter_multistatus(response.content)]
+
+    def watch_cal_list(self, channel_id, address, token, credentials):
+        with build('calendar', 'v3', credentials=credentials) as service:
+            return service.calendarList().watch(body=self._channel_body(channel_id, address, token)).execute()
+
+    def watch_cal_events(self, cal_id, channel_id, address, token, credentials):
+        with build('calendar', 'v3', credentials=credentials) as service:
+            return service.events().watch(
+                calendarId=cal_id, body=self._channel_body(channel_id, address, token)).execute()
+
+    def stop_channel(self, channel_id, resource_id, credentials):
+        with build('calendar', 'v3', credentials=credentials) as service:
+            try:
+                service.channels().stop(body={'id': channel_id, 'resourceId': resource_id}).execute()
+            except HttpError as e:
+                if e.resp.status != 404:  # Already expired
+                    raise
+
+    def _channel_body(self, channel_id, address, token):
+        return {'id': channel_id, 'type': 'web_hook', 'address': address, 'token': token}
+
+    def _request_with_token(self, url, credentials, raise_for_status=True, method='GET', data=None, headers=None):
+        headers = {**(headers or {}), 'Authorization': f"Bearer {credentials.token}"}
+        response = requests.request(method, url, headers=headers, data=data)
+        if raise_for_status:
+            response.raise_for_status()
+        return response
+
+
+class AsyncGoogleApis():
+
+    def __init__(self, max_connections=4):
+        if httpx is None:
+            raise GcalvaultError(
+                "Async mode requires the 'async' extra, install it with: pip install 'gcalvault[async]'")
+        self._max_connections = max_connections
+        # httpx clients are bound to the event loop they're first used on, so
+        # there's one per loop (e.g. per thread running its own asyncio.run)
+        self._clients = weakref.WeakKeyDictionary()
+
+    async def request_cal_list(self, credentials):
+        items = []
+        params = {}
+        while True:
+            response = await self._request_with_token(GOOGLE_CAL_LIST_URI, credentials, params=params)
+            calendar_list = response.json()
+            items.extend(calendar_list.get('items', []))
+            if not calendar_list.get('nextPageToken'):
+                return {'items': items}
+            params = {'pageToken': calendar_list['nextPageToken']}
+
+    async def request_cal_as_ical(self, cal_id, credentials, time_min=None, time_max=None):
+        url = GOOGLE_CALDAV_URI_FORMAT.format(cal_id=urllib.parse.quote(cal_id))
+        if time_min is None and time_max is None:
+            return (await self._request_with_token(url, credentials)).text
+        response = await self._request_with_token(
+            url, credentials, method='REPORT', content=calendar_query_body(time_min, time_max), headers=REPORT_HEADERS)
+        return merge_calendars(data for (_, _, data) in iter_multistatus(response.content) if data)
+
+    async def request_cal_etags(self, cal_id, credentials, time_min=None, time_max=None):
+        url = GOOGLE_CALDAV_URI_FORMAT.format(cal_id=urllib.parse.quote(cal_id))
+        response = await self._request_with_token(
+            url, credentials, method='REPORT', content=calendar_query_body(time_min, time_max, with_data=False),
+            headers=REPORT_HEADERS)
+        return [(href, etag) for (href, etag, _) in iter_multistatus(response.content)]
+
+    async def aclose(self):
+        # Closes the client of the running event loop
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
 
-    def _request_with_token(self, url, credentials, raise_for_status=True):
-        headers = {'Authorization': f"Bearer {credentials.token}"}
-        response = requests.get(url, headers=headers)
+    async def _request_with_token(self, url, credentials, params=None, raise_for_status=True,
+                                  method='GET', content=None, headers=None):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            # HTTP/2 multiplexes concurrent requests to the same host over a
+            # handful of connections
+            client = self._clients[loop] = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=self._max_connections),
+                timeout=httpx.Timeout(60.0))
+        headers = {**(headers or {}), 'Authorization': f"Bearer {credentials.token}"}
+        response = await client.request(method, url, headers=headers, params=params, content=content)
         if raise_for_status:
             response.raise_for_status()
         return response
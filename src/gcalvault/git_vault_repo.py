@@ -1,5 +1,14 @@
+import io
 import os
-from git import Repo, exc
+import glob
+import time
+import shutil
+import tempfile
+import contextlib
+from git import Repo, Actor, Commit, exc
+from git.objects.util import altz_to_utctz_str, parse_date
+
+from .hash_manager import hash_file
 
 
 class GitVaultRepo():
@@ -8,6 +17,7 @@ class GitVaultRepo():
         self._package_name = package_name
         self._extensions = extensions
         self._repo = None
+        self._head_blobs = None
         
         try:
             self._repo = Repo(dir_path)
@@ -30,7 +40,9 @@ class GitVaultRepo():
             self._dry_run = True
             self._msg_prefix = "[DRY RUN] "
 
-    def add_file(self, file_name):
+    def add_file(self, file_name, blob_sha=None):
+        # blob_sha, the file's git blob id if already known, isn't needed here:
+        # the index hashes the file as it writes it to the object database
         print(f"{self._msg_prefix}Adding {file_name} to {self._package_name} repository")
         if not self._dry_run:
             self._repo.index.add(file_name)
@@ -46,7 +58,16 @@ class GitVaultRepo():
         if not self._dry_run:
             self._repo.index.remove([file_name], working_tree=True)
 
+    def committed_blob_sha(self, file_name):
+        if self._head_blobs is None:
+            try:
+                self._head_blobs = {blob.path: blob.hexsha for blob in self._repo.head.commit.tree.blobs}
+            except ValueError:  # No commits yet
+                self._head_blobs = {}
+        return self._head_blobs.get(file_name)
+
     def commit(self, message):
+        self._head_blobs = None
         if not self._dry_run:
             changes = self._repo.index.diff(self._repo.head.commit)
             if (changes):
@@ -66,3 +87,184 @@ class GitVaultRepo():
                 print(f'!*{ext}', file=file)
         self._repo.index.add('.gitignore')
         self._repo.index.commit("Add .gitignore")
+
+
+# Builds each commit by streaming changed files into `git fast-import` instead
+# of going through GitPython's pure-Python index. Trees, messages, identities and
+# dates match GitVaultRepo; afterwards only the changed index entries are patched (via
+# `git update-index --index-info`), so both engines can be used on the same vault.
+class FastImportGitVaultRepo(GitVaultRepo):
+
+    def __init__(self, package_name, package_version, dir_path, extensions):
+        super().__init__(package_name, package_version, dir_path, extensions)
+        self._pending = {}
+
+    def add_file(self, file_name, blob_sha=None):
+        print(f"{self._msg_prefix}Adding {file_name} to {self._package_name} repository")
+        if not self._dry_run:
+            self._pending[file_name] = blob_sha or True
+
+    def add_all_files(self):
+        for ext in self._extensions:
+            print(f"{self._msg_prefix}Adding all {ext} files to {self._package_name} repository")
+            if not self._dry_run:
+                for file_path in glob.glob(os.path.join(glob.escape(self._repo.working_dir), f'*{ext}')):
+                    self._pending[os.path.basename(file_path)] = True
+
+    def remove_file(self, file_name):
+        print(f"{self._msg_prefix}Removing {file_name} from {self._package_name} repository")
+        if not self._dry_run:
+            file_path = os.path.join(self._repo.working_dir, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            self._pending[file_name] = False
+
+    def commit(self, message):
+        self._head_blobs = None
+        if not self._dry_run:
+            head_commit = self._repo.head.commit
+            head_blobs = {blob.path: blob.hexsha for blob in head_commit.tree.blobs}
+
+            changes = []
+            for file_name, present in self._pending.items():
+                if present:
+                    blob_sha = present if present is not True else \
+                        hash_file(os.path.join(self._repo.working_dir, file_name))
+                    if head_blobs.get(file_name) != blob_sha:
+                        changes.append((file_name, blob_sha))
+                elif file_name in head_blobs:
+                    changes.append((file_name, None))
+            self._pending = {}
+
+            if (changes):
+                self._fast_import(head_commit, changes, message)
+                self._update_index(changes)
+                print(f"Committed {len(changes)} revision(s) to {self._package_name} repository")
+            else:
+                print(f"No revisions to commit to {self._package_name} repository")
+        else:
+            print(f"{self._msg_prefix}Committing revision(s) to {self._package_name} repository")
+
+    def _fast_import(self, head_commit, changes, message):
+        config_reader = self._repo.config_reader()
+        committer = Actor.committer(config_reader)
+        author = Actor.author(config_reader)
+        author_date = _commit_date(Commit.env_author_date)
+        committer_date = _commit_date(Commit.env_committer_date)
+        message_bytes = message.encode('utf-8')
+
+        with tempfile.TemporaryFile() as stream:
+            stream.write(f"commit {self._repo.head.reference.path}\n".encode('utf-8'))
+            stream.write(f"author {author.name} <{author.email}> {author_date}\n".encode('utf-8'))
+            stream.write(f"committer {committer.name} <{committer.email}> {committer_date}\n".encode('utf-8'))
+            stream.write(f"data {len(message_bytes)}\n".encode('utf-8') + message_bytes + b"\n")
+            stream.write(f"from {head_commit.hexsha}\n".encode('utf-8'))
+            for (file_name, blob_sha) in changes:
+                path = _quote_path(file_name)
+                if blob_sha is None:
+                    stream.write(f"D {path}\n".encode('utf-8'))
+                    continue
+                file_path = os.path.join(self._repo.working_dir, file_name)
+                stream.write(f"M 100644 inline {path}\ndata {os.path.getsize(file_path)}\n".encode('utf-8'))
+                with open(file_path, 'rb') as file:
+                    shutil.copyfileobj(file, stream)
+                stream.write(b"\n")
+            stream.write(b"done\n")
+            stream.seek(0)
+            self._repo.git.execute(
+                ['git', 'fast-import', '--quiet', '--done', '--date-format=raw'], istream=stream)
+
+    def _update_index(self, changes):
+        index_info = ""
+        for (file_name, blob_sha) in changes:
+            if blob_sha is None:
+                index_info += f"0 {'0' * 40}\t{_quote_path(file_name)}\n"
+            else:
+                index_info += f"100644 {blob_sha}\t{_quote_path(file_name)}\n"
+        with tempfile.TemporaryFile() as stream:
+            stream.write(index_info.encode('utf-8'))
+            stream.seek(0)
+            self._repo.git.execute(['git', 'update-index', '--index-info'], istream=stream)
+
+
+# Dates as Commit.create_from_tree (used by the index engine) sets them: now,
+# unless overridden by GIT_AUTHOR_DATE / GIT_COMMITTER_DATE
+def _commit_date(env_var):
+    date_str = os.environ.get(env_var, "")
+    if date_str:
+        (unix_time, offset) = parse_date(date_str)
+    else:
+        is_dst = time.daylight and time.localtime().tm_isdst > 0
+        (unix_time, offset) = (int(time.time()), time.altzone if is_dst else time.timezone)
+    return f"{unix_time} {altz_to_utctz_str(offset)}"
+
+
+def _quote_path(file_name):
+    if file_name.startswith('"') or '\n' in file_name or '\\' in file_name:
+        escaped = file_name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return f'"{escaped}"'
+    return file_name
+
+
+# Stands in for a GitVaultRepo while a vault's calendars are downloaded, only
+# recording what to add and remove. On commit, the recorded work is handed to
+# submit_fn, which schedules it to be replayed in a real repo of class repo_cls
+# (typically in another process, see replay_deferred_commit) and returns a
+# future of its output. This
+# way the CPU-bound git work (hashing, compression, index and tree writes) of
+# many vaults can run in parallel, without the GIL in the way.
+class DeferredGitVaultRepo():
+
+    def __init__(self, repo_cls, package_name, package_version, dir_path, extensions, submit_fn):
+        self._job = {
+            'repo_cls': repo_cls,
+            'package_name': package_name,
+            'package_version': package_version,
+            'dir_path': dir_path,
+            'extensions': extensions,
+            'operations': [],
+        }
+        self._submit_fn = submit_fn
+        self._head_blobs = None
+
+    def add_file(self, file_name, blob_sha=None):
+        self._job['operations'].append(('add', file_name, blob_sha))
+
+    def add_all_files(self):
+        self._job['operations'].append(('add_all', None, None))
+
+    def remove_file(self, file_name):
+        self._job['operations'].append(('remove', file_name, None))
+
+    def committed_blob_sha(self, file_name):
+        if self._head_blobs is None:
+            try:
+                head_commit = Repo(self._job['dir_path']).head.commit
+                self._head_blobs = {blob.path: blob.hexsha for blob in head_commit.tree.blobs}
+            except (exc.InvalidGitRepositoryError, exc.NoSuchPathError, ValueError):
+                self._head_blobs = {}
+        return self._head_blobs.get(file_name)
+
+    def commit(self, message):
+        print(self.submit_commit(message).result(), end="")
+
+    def submit_commit(self, message):
+        job = dict(self._job, message=message)
+        self._job['operations'] = []
+        self._head_blobs = None
+        return self._submit_fn(job)
+
+
+def replay_deferred_commit(job):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        repo = job['repo_cls'](job['package_name'], job['package_version'], job['dir_path'], job['extensions'])
+        for (operation, file_name, blob_sha) in job['operations']:
+            if operation == 'add':
+                repo.add_file(file_name, blob_sha)
+            elif operation == 'add_all':
+                repo.add_all_files()
+            else:
+                repo.remove_file(file_name)
+        repo.commit(job['message'])
+    return output.getvalue()
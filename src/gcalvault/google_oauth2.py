@@ -1,11 +1,11 @@
-import os
 import json
 import webbrowser
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
+from .credential_manager import CredentialManager
+
 
 GOOGLE_AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
 GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
@@ -13,28 +13,28 @@ GOOGLE_AUTH_CERTS_URI = "https://www.googleapis.com/oauth2/v1/certs"
 
 
 class GoogleOAuth2():
-    def __init__(self, app_name, authorize_command_fn):
+    def __init__(self, app_name, authorize_command_fn, credential_manager=None):
         self.app_name = app_name
         self.authorize_command_fn = authorize_command_fn
+        self.credential_manager = credential_manager if credential_manager is not None else CredentialManager()
 
     def get_credentials(self, token_file_path, client_id, client_secret, scopes, email_addr):
-        credentials = None
         new_authorization = False
 
-        if os.path.exists(token_file_path):
-            credentials = Credentials.from_authorized_user_file(token_file_path, scopes)
+        credentials = self.credential_manager.load(token_file_path, scopes)
 
-        if credentials and credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-            self._save_credentials(credentials, token_file_path)
-            print(f"Credentials refreshed, token saved to {token_file_path}")
-        
-        elif not credentials or not credentials.valid:
+        if credentials:
+            credentials = self.credential_manager.refresh_if_needed(credentials, token_file_path)
+
+        if not credentials or not credentials.valid:
             credentials = self.authz_and_save_token(token_file_path, client_id, client_secret, scopes, email_addr)
             new_authorization = True
 
         return (credentials, new_authorization)
 
+    def refresh_if_needed(self, credentials, token_file_path):
+        return self.credential_manager.refresh_if_needed(credentials, token_file_path)
+
     def authz_and_save_token(self, token_file_path, client_id, client_secret, scopes, email_addr):
         if self._check_is_headless():
             print(f'''
@@ -112,8 +112,7 @@ Authorization successful, paste the following into your remote machine --->
         return credentials
     
     def _save_credentials(self, credentials, token_file_path):
-        with open(token_file_path, 'w') as token:
-            token.write(credentials.to_json())
+        self.credential_manager.save(credentials, token_file_path)
     
     def _validate_user_in_token(self, credentials, email_addr):
         user_info = self.request_user_info(credentials)
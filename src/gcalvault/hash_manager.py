@@ -0,0 +1,84 @@
+import os
+import hashlib
+
+from .file_lock import write_atomic
+
+
+# Git blob ids of the calendar files written by the last syncs, along with
+# the size and modification time they had once written. As long as a file's
+# size and mtime are unchanged, its recorded blob id can be trusted without
+# reading the file again (the same assumption git's index makes).
+
+
+class HashManager():
+
+    def __init__(self, conf_dir, user):
+        self._hash_file_path = os.path.join(conf_dir, f"{user}.hashes")
+        self._entries = self._read_hash_file()
+
+    def known_hash(self, dir_path, file_name):
+        entry = self._entries.get(file_name)
+        if entry is None:
+            return None
+        (blob_sha, size, mtime_ns) = entry
+        try:
+            stat = os.stat(os.path.join(dir_path, file_name))
+        except FileNotFoundError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            return None
+        return blob_sha
+
+    def record(self, dir_path, file_name, blob_sha):
+        stat = os.stat(os.path.join(dir_path, file_name))
+        self._entries[file_name] = (blob_sha, stat.st_size, stat.st_mtime_ns)
+
+    def remove(self, file_name):
+        self._entries.pop(file_name, None)
+
+    def verify(self, dir_path, file_name):
+        # None if nothing is recorded for the file, otherwise whether it still
+        # has the content recorded for it (read only if its stat changed)
+        entry = self._entries.get(file_name)
+        if entry is None:
+            return None
+        if self.known_hash(dir_path, file_name) is not None:
+            return True
+        file_path = os.path.join(dir_path, file_name)
+        if not os.path.exists(file_path) or hash_file(file_path) != entry[0]:
+            return False
+        self.record(dir_path, file_name, entry[0])
+        return True
+
+    def save(self):
+        write_atomic(
+            self._hash_file_path,
+            "".join(f"{file_name}\t{blob_sha}\t{size}\t{mtime_ns}\n"
+                    for file_name, (blob_sha, size, mtime_ns) in self._entries.items()),
+            fsync=False)  # Losing it in a crash just means hashing files again
+
+    def _read_hash_file(self):
+        entries = {}
+        if os.path.exists(self._hash_file_path):
+            with open(self._hash_file_path, 'r') as file:
+                for line in file:
+                    try:
+                        (file_name, blob_sha, size, mtime_ns) = line.rstrip('\n').split('\t')
+                        entries[file_name] = (blob_sha, int(size), int(mtime_ns))
+                    except ValueError:  # e.g. truncated, the file is then simply hashed again
+                        continue
+        return entries
+
+
+def hash_blob(data):
+    digest = hashlib.sha1(f"blob {len(data)}\0".encode('utf-8'))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def hash_file(file_path):
+    digest = hashlib.sha1(f"blob {os.path.getsize(file_path)}\0".encode('utf-8'))
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import bisect
+import binascii
+from git import Repo, exc
+
+from .file_lock import file_lock, write_atomic
+
+
+class HistoryIndex():
+
+    def __init__(self, dir_path):
+        self._repo = Repo(dir_path)
+        self._index_dir_path = os.path.join(self._repo.git_dir, "gcalvault", "history")
+        self._marker_file_path = os.path.join(self._index_dir_path, ".indexed")
+        # Outside of the index dir, which is removed when history is rewritten
+        self._lock_file_path = os.path.join(self._repo.git_dir, "gcalvault", "history.lock")
+
+    def find_blob_at_time(self, file_name, timestamp):
+        self.refresh()
+        entries = self._read_entries(file_name)
+        pos = bisect.bisect_right([commit_time for (commit_time, _) in entries], timestamp)
+        if pos == 0:
+            return None
+        return entries[pos - 1][1]
+
+    def find_blob_at_commit(self, file_name, rev):
+        try:
+            commit = self._repo.commit(rev)
+        except (exc.BadName, ValueError):
+            raise ValueError(f"Unknown revision '{rev}'")
+        try:
+            return (commit.tree / file_name).hexsha
+        except KeyError:
+            return None
+
+    def stream_blob(self, blob_sha, out, chunk_size=1024 * 1024):
+        stream = self._repo.odb.stream(binascii.unhexlify(blob_sha))
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            out.write(chunk)
+
+    def refresh(self):
+        if not self._repo.head.is_valid():
+            return
+        os.makedirs(os.path.dirname(self._lock_file_path), exist_ok=True)
+        # Concurrent refreshes (e.g. of two 'show' runs) would otherwise both
+        # append the same new entries
+        with file_lock(self._lock_file_path):
+            self._refresh()
+
+    def _refresh(self):
+        head_sha = self._repo.head.commit.hexsha
+        last_sha = self._read_marker()
+        if last_sha == head_sha:
+            return
+
+        if last_sha and not self._is_ancestor(last_sha, head_sha):
+            shutil.rmtree(self._index_dir_path)
+            last_sha = None
+        os.makedirs(self._index_dir_path, exist_ok=True)
+
+        new_entries = {}
+        proc = self._repo.git.execute(
+            ['git', '-c', 'core.quotePath=false', 'log', '--reverse', '--raw', '--no-abbrev',
+                '--no-renames', '--format=commit %H %ct',
+                f"{last_sha}..{head_sha}" if last_sha else head_sha],
+            as_process=True)
+        commit_time = None
+        for line in proc.stdout:
+            line = line.decode('utf-8').rstrip('\n')
+            if line.startswith('commit '):
+                commit_time = line.split()[2]
+            elif line.startswith(':'):
+                (meta, file_name) = line.split('\t', 1)
+                (_, _, _, new_sha, status) = meta.split()
+                blob_sha = '-' if status == 'D' else new_sha
+                new_entries.setdefault(file_name, []).append(f"{commit_time}\t{blob_sha}")
+        proc.wait()
+
+        for file_name, lines in new_entries.items():
+            with open(os.path.join(self._index_dir_path, file_name), 'a') as file:
+                for line in lines:
+                    print(line, file=file)
+        write_atomic(self._marker_file_path, f"{head_sha}\n", fsync=False)
+
+    def _read_entries(self, file_name):
+        # Entries may be repeated if a refresh was interrupted before writing
+        # its marker, in which case the next refresh appends them again
+        entries = {}
+        entries_file_path = os.path.join(self._index_dir_path, file_name)
+        if os.path.exists(entries_file_path):
+            with open(entries_file_path, 'r') as file:
+                for line in file:
+                    (commit_time, blob_sha) = line.split()
+                    entries[(int(commit_time), None if blob_sha == '-' else blob_sha)] = None
+        return sorted(entries, key=lambda entry: entry[0])
+
+    def _read_marker(self):
+        if os.path.exists(self._marker_file_path):
+            with open(self._marker_file_path, 'r') as file:
+                return file.read().strip()
+        return None
+
+    def _is_ancestor(self, ancestor_sha, sha):
+        try:
+            self._repo.git.merge_base('--is-ancestor', ancestor_sha, sha)
+            return True
+        except exc.GitCommandError:
+            return False
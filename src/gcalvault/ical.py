@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+
+# Minimal, streaming iCalendar (RFC 5545) reader. Yields the VEVENT components
+# of a calendar one at a time, so large exports never need to be held in
+# memory as parsed objects.
+
+
+class Event():
+
+    def __init__(self):
+        self.lines = []
+        self.properties = []
+
+    @property
+    def uid(self):
+        return self.get('UID', '')
+
+    @property
+    def recurrence_id(self):
+        return self.get('RECURRENCE-ID')
+
+    @property
+    def key(self):
+        return (self.uid, self.recurrence_id or '')
+
+    @property
+    def sequence(self):
+        try:
+            return int(self.get('SEQUENCE', '0'))
+        except ValueError:
+            return 0
+
+    @property
+    def summary(self):
+        return unescape_text(self.get('SUMMARY', ''))
+
+    @property
+    def organizer(self):
+        return _strip_mailto(self.get('ORGANIZER'))
+
+    @property
+    def attendees(self):
+        return [_strip_mailto(value) for value in self.get_all('ATTENDEE')]
+
+    @property
+    def start(self):
+        return self.get_datetime('DTSTART')
+
+    @property
+    def end(self):
+        return self.get_datetime('DTEND')
+
+    @property
+    def all_day(self):
+        return self.get_param('DTSTART', 'VALUE', '').upper() == 'DATE'
+
+    def days(self, default_tzid=None):
+        # First and last calendar days (YYYY-MM-DD) the event occupies, in its
+        # own time zone. UTC times are converted to default_tzid (usually the
+        # calendar's X-WR-TIMEZONE), other times already are local.
+        (start, _) = self.start
+        (end, _) = self.end
+        if not start:
+            return (None, None)
+        if self.all_day or len(start) == 10:
+            if end and end > start:
+                # DTEND is exclusive for all-day events
+                return (start[:10], (datetime.fromisoformat(end[:10]) - timedelta(days=1)).date().isoformat())
+            return (start[:10], start[:10])
+        try:
+            zone = _zone(default_tzid)
+            first = _local_datetime(start, zone)
+            last = _local_datetime(end, zone) if end else first
+        except ValueError:
+            return (start[:10], (end or start)[:10])
+        if last > first:
+            last -= timedelta(microseconds=1)  # DTEND is exclusive
+        return (first.date().isoformat(), max(first, last).date().isoformat())
+
+    def get(self, name, default=None):
+        for (prop_name, _, value) in self.properties:
+            if prop_name == name:
+                return value
+        return default
+
+    def get_all(self, name):
+        return [value for (prop_name, _, value) in self.properties if prop_name == name]
+
+    def get_param(self, name, param, default=None):
+        for (prop_name, params, _) in self.properties:
+            if prop_name == name:
+                return params.get(param, default)
+        return default
+
+    def get_datetime(self, name):
+        for (prop_name, params, value) in self.properties:
+            if prop_name == name:
+                return (format_datetime(value), params.get('TZID'))
+        return (None, None)
+
+
+def iter_events(source, calendar_properties=None):
+    # If calendar_properties is a dict, the properties of the calendar itself
+    # (e.g. X-WR-TIMEZONE) are added to it as they're read, which for exports
+    # from Google is before the first event.
+    if isinstance(source, str):
+        source = _iter_str_lines(source)
+
+    event = None
+    depth = 0
+    other_depth = 0
+    for line in iter_unfolded_lines(source):
+        if event is None and calendar_properties is not None and line not in ('BEGIN:VCALENDAR', 'END:VCALENDAR'):
+            if line.startswith('BEGIN:') and line != 'BEGIN:VEVENT':
+                other_depth += 1
+            elif line.startswith('END:'):
+                other_depth -= 1
+            elif other_depth == 0 and not line.startswith('BEGIN:'):
+                (name, _, value) = parse_property(line)
+                calendar_properties.setdefault(name, value)
+        if line.startswith('BEGIN:'):
+            if event is None and line == 'BEGIN:VEVENT':
+                event = Event()
+            elif event is not None:
+                depth += 1
+        if event is not None:
+            event.lines.append(line)
+            if depth == 0 and not line.startswith(('BEGIN:', 'END:')):
+                event.properties.append(parse_property(line))
+        if line.startswith('END:') and event is not None:
+            if depth == 0:
+                yield event
+                event = None
+            else:
+                depth -= 1
+
+
+def iter_unfolded_lines(source):
+    current = None
+    for line in source:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def _iter_str_lines(text):
+    # Not io.StringIO, which copies the text into a buffer of 4 bytes per
+    # character, 4x the size of the (typically ASCII) calendar being parsed
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        end = len(text) if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+
+
+def parse_property(line):
+    if '"' not in line:
+        (head, _, value) = line.partition(':')
+        (name, *params) = head.split(';')
+        return (name.upper(), dict(_split_param(param) for param in params), value)
+
+    name_end = len(line)
+    value_start = len(line)
+    in_quotes = False
+    for pos, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ';' and not in_quotes and name_end == len(line):
+            name_end = pos
+        elif char == ':' and not in_quotes:
+            value_start = pos
+            break
+    name = line[:min(name_end, value_start)].upper()
+
+    params = {}
+    if name_end < value_start:
+        param = ''
+        in_quotes = False
+        for char in line[name_end + 1:value_start] + ';':
+            if char == '"':
+                in_quotes = not in_quotes
+            elif char == ';' and not in_quotes:
+                (param_name, param_value) = _split_param(param)
+                params[param_name] = param_value
+                param = ''
+            else:
+                param += char
+
+    return (name, params, line[value_start + 1:])
+
+
+def format_datetime(value):
+    value = value.strip()
+    if len(value) >= 8 and value[:8].isdigit():
+        text = f"{value[0:4]}-{value[4:6]}-{value[6:8]}"
+        if len(value) >= 15 and value[8] == 'T':
+            text += f"T{value[9:11]}:{value[11:13]}:{value[13:15]}{value[15:16]}"
+        return text
+    return value or None
+
+
+def _zone(tzid):
+    if not tzid:
+        return None
+    try:
+        return ZoneInfo(tzid)
+    except (KeyError, ValueError):  # Unknown time zone
+        return None
+
+
+def _local_datetime(value, zone):
+    if value.endswith('Z'):
+        moment = datetime.fromisoformat(value[:-1]).replace(tzinfo=timezone.utc)
+        return (moment.astimezone(zone) if zone else moment).replace(tzinfo=None)
+    return datetime.fromisoformat(value)
+
+
+def unescape_text(value):
+    if '\\' not in value:
+        return value
+    result = ''
+    escaped = False
+    for char in value:
+        if escaped:
+            result += '\n' if char in 'nN' else char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            result += char
+    return result
+
+
+def _split_param(param):
+    (param_name, _, param_value) = param.partition('=')
+    return (param_name.upper(), param_value.strip('"'))
+
+
+def _strip_mailto(value):
+    if value is None:
+        return None
+    return value[7:] if value.lower().startswith('mailto:') else value
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+
+from .file_lock import write_atomic
+
+
+# Leases guard a user's vault and conf dir files against concurrent syncs,
+# including from other hosts sharing the filesystem (so they don't rely on
+# file locking, which isn't dependable over network filesystems). A lease is
+# a file created exclusively, holding its owner and expiry; the owner renews
+# it from a heartbeat thread. A lease that has expired (its owner crashed, or
+# hung for longer than the TTL) can be taken over by another worker. Expiry
+# is compared across hosts, so their clocks are assumed to be roughly in sync.
+
+LEASE_TTL = 5 * 60
+
+
+class Lease():
+
+    def __init__(self, file_path, ttl=LEASE_TTL, heartbeat_interval=None):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lost = False
+        self._heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else ttl / 3
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        # A couple of attempts, in case the lease was released (or broken)
+        # between failing to create it and reading who holds it
+        for _ in range(3):
+            if self._create():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+                self._thread.start()
+                return True
+            holder = self.holder()
+            if holder is not None and holder['expires'] > time.time():
+                return False
+            if holder is not None:
+                self._break(holder)
+        return False
+
+    def release(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._is_owner():
+            os.remove(self.file_path)
+
+    def verify(self):
+        # The heartbeat only notices a lost lease periodically, so check again
+        # before doing anything that must not be done without it
+        if not self._is_owner():
+            self.lost = True
+        return not self.lost
+
+    def holder(self):
+        try:
+            with open(self.file_path, 'r') as file:
+                content = file.read()
+            mtime = os.path.getmtime(self.file_path)
+        except FileNotFoundError:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            # Just created and not written yet (or the writer died right then)
+            return {'owner': "unknown", 'expires': mtime + self.ttl}
+
+    def _create(self):
+        try:
+            fd = os.open(self.file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as file:
+            file.write(self._content())
+            file.flush()
+            os.fsync(file.fileno())
+        return True
+
+    def _break(self, stale_holder):
+        # Only one worker may break a stale lease, otherwise one could delete
+        # the lease another has just taken over
+        breaker_file_path = f"{self.file_path}.break"
+        try:
+            fd = os.open(breaker_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                if os.path.getmtime(breaker_file_path) + self.ttl < time.time():
+                    os.remove(breaker_file_path)
+            except FileNotFoundError:
+                pass
+            return
+        os.close(fd)
+        try:
+            holder = self.holder()
+            if holder is not None and holder['owner'] == stale_holder['owner'] and holder['expires'] <= time.time():
+                os.remove(self.file_path)
+                print(f"Took over expired lease '{self.file_path}' from {holder['owner']}")
+        finally:
+            os.remove(breaker_file_path)
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self._heartbeat_interval):
+            if not self.verify():
+                print(f"WARNING: Lease '{self.file_path}' was taken over by another worker")
+                return
+            write_atomic(self.file_path, self._content())
+
+    def _is_owner(self):
+        holder = self.holder()
+        return holder is not None and holder['owner'] == self.owner
+
+    def _content(self):
+        return json.dumps({'owner': self.owner, 'expires': time.time() + self.ttl})
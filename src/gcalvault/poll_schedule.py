@@ -0,0 +1,87 @@
+import os
+import time
+import hashlib
+
+from .file_lock import write_atomic
+
+
+# Calendars whose etag changed at their last check are checked again after
+# MIN_INTERVAL; each unchanged check doubles the interval, up to MAX_INTERVAL.
+MIN_INTERVAL = 15 * 60
+MAX_INTERVAL = 7 * 24 * 60 * 60
+
+# The calendar list itself is scheduled like a calendar, so that new calendars
+# are still discovered when all of the known ones are dormant.
+CALENDAR_LIST_KEY = "*"
+
+
+class PollSchedule():
+
+    def __init__(self, conf_dir, user, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self._schedule_file_path = os.path.join(conf_dir, f"{user}.schedule")
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._entries = self._read_schedule_file()
+
+    def is_due(self, object_name, now=None):
+        return self.next_check(object_name) <= (now if now is not None else time.time())
+
+    def any_due(self, now=None):
+        return any(self.is_due(key, now) for key in [CALENDAR_LIST_KEY] + list(self._entries))
+
+    def next_check(self, object_name):
+        entry = self._entries.get(_key(object_name))
+        if entry is None:
+            return 0
+        (last_checked, interval, _, _) = entry
+        return last_checked + interval
+
+    def has_changed(self, object_name, fingerprint):
+        entry = self._entries.get(_key(object_name))
+        return entry is None or entry[3] != _fingerprint(fingerprint)
+
+    def record_check(self, object_name, fingerprint, now=None):
+        now = int(now if now is not None else time.time())
+        key = _key(object_name)
+        fingerprint = _fingerprint(fingerprint)
+        entry = self._entries.get(key)
+        if entry is None or entry[3] != fingerprint:
+            self._entries[key] = (now, self._min_interval, now, fingerprint)
+        else:
+            (_, interval, last_changed, _) = entry
+            self._entries[key] = (now, min(interval * 2, self._max_interval), last_changed, fingerprint)
+
+    def record_calendar_list(self, object_names, now=None):
+        keys = set(_key(object_name) for object_name in object_names)
+        for key in list(self._entries):
+            if key != CALENDAR_LIST_KEY and key not in keys:
+                del self._entries[key]
+        fingerprint = hashlib.sha1("\n".join(sorted(keys)).encode('utf-8')).hexdigest()
+        self.record_check(CALENDAR_LIST_KEY, fingerprint, now)
+
+    def save(self):
+        write_atomic(
+            self._schedule_file_path,
+            "".join(f"{key}\t{last_checked}\t{interval}\t{last_changed}\t{fingerprint}\n"
+                    for key, (last_checked, interval, last_changed, fingerprint) in self._entries.items()),
+            fsync=False)  # Losing it in a crash just means checking everything again
+
+    def _read_schedule_file(self):
+        entries = {}
+        if os.path.exists(self._schedule_file_path):
+            with open(self._schedule_file_path, 'r') as file:
+                for line in file:
+                    try:
+                        (key, last_checked, interval, last_changed, fingerprint) = line.split()
+                        entries[key] = (int(last_checked), int(interval), int(last_changed), fingerprint)
+                    except ValueError:  # e.g. truncated, the object is then simply due
+                        continue
+        return entries
+
+
+def _key(object_name):
+    return "_".join(object_name.strip().lower().split())
+
+
+def _fingerprint(fingerprint):
+    return _key(fingerprint.strip('"')) or "-"
@@ -0,0 +1,125 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+import contextlib
+import contextvars
+
+
+# Profiles a sync with cProfile (and optionally tracemalloc), and times the
+# phases of the sync that are marked with Profiler.phase(). Phases are no-ops
+# unless a profile is being captured. Each profile is written as:
+# - <prefix>.pstats: cProfile stats, for pstats, snakeviz, flameprof, gprof2dot...
+# - <prefix>.folded: time spent (ms) in each phase as folded stacks, for
+#   flamegraph.pl, speedscope, inferno...
+# - <prefix>.txt: summary of phases, top functions and (with memory) allocations
+# - <prefix>.tracemalloc: with memory, a snapshot loadable with tracemalloc.Snapshot.load
+
+# Phases are tracked per context, so phases of concurrent asyncio tasks nest
+# under the phase that started the task rather than under each other
+_phases = contextvars.ContextVar('gcalvault_profiler_phases', default=())
+
+TOP_COUNT = 30
+
+# cProfile and tracemalloc are process-wide, so only one profile can be
+# captured at a time (e.g. across users synced concurrently with run_async or
+# in threads). Held while capturing, tried without blocking.
+_capturing = threading.Lock()
+
+
+class Profiler():
+
+    def __init__(self):
+        self._cprofile = None
+        self._timings = {}
+
+    @property
+    def active(self):
+        return self._cprofile is not None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.active:
+            yield
+            return
+        stack = _phases.get() + (name,)
+        token = _phases.set(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _phases.reset(token)
+            (total, count) = self._timings.get(stack, (0.0, 0))
+            self._timings[stack] = (total + elapsed, count + 1)
+
+    @contextlib.contextmanager
+    def profile(self, path_prefix, name, memory=False):
+        if not _capturing.acquire(blocking=False):
+            print("WARNING: Another profile is being captured in this process, not profiling")
+            yield
+            return
+
+        start_snapshot = None
+        owns_tracemalloc = memory and not tracemalloc.is_tracing()
+        if owns_tracemalloc:
+            tracemalloc.start()
+        if memory:
+            start_snapshot = tracemalloc.take_snapshot()
+        self._timings = {}
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        try:
+            with self.phase(name):
+                yield
+        finally:
+            self._cprofile.disable()
+            snapshot = peak = None
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+            if owns_tracemalloc:
+                tracemalloc.stop()
+            try:
+                self._save(path_prefix, start_snapshot, snapshot, peak)
+            finally:
+                self._cprofile = None
+                _capturing.release()
+            print(f"Saved profile to {path_prefix}.*")
+
+    def _save(self, path_prefix, start_snapshot, snapshot, peak):
+        self._cprofile.dump_stats(f"{path_prefix}.pstats")
+
+        with open(f"{path_prefix}.folded", 'w') as file:
+            for (stack, (total, _)) in sorted(self._timings.items()):
+                children = sum(child_total for (child, (child_total, _)) in self._timings.items()
+                               if child[:-1] == stack)
+                self_ms = round(max(total - children, 0) * 1000)
+                if self_ms > 0:
+                    print(f"{';'.join(stack)} {self_ms}", file=file)
+
+        with open(f"{path_prefix}.txt", 'w') as file:
+            print("Phases (concurrent phases may add up to more than their parent):", file=file)
+            for (stack, (total, count)) in sorted(self._timings.items()):
+                print(f"  {'  ' * (len(stack) - 1)}{stack[-1]:<{24 - 2 * len(stack)}} "
+                      f"{total:10.3f}s {count:8d} call(s)", file=file)
+            print(file=file)
+
+            if snapshot is not None:
+                print(f"Peak traced memory: {peak / (1024 * 1024):.1f} MiB", file=file)
+                print(f"Top {TOP_COUNT} allocation sites (growth during sync):", file=file)
+                filters = [
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__),
+                ]
+                stats = snapshot.filter_traces(filters).compare_to(start_snapshot.filter_traces(filters), 'lineno')
+                for stat in stats[:TOP_COUNT]:
+                    print(f"  {stat}", file=file)
+                print(file=file)
+                snapshot.dump(f"{path_prefix}.tracemalloc")
+
+            stream = io.StringIO()
+            pstats.Stats(self._cprofile, stream=stream).sort_stats('cumulative').print_stats(TOP_COUNT)
+            file.write(stream.getvalue())
@@ -0,0 +1,183 @@
+import time
+import uuid
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Channels are renewed this long before Google expires them
+RENEW_MARGIN = 60 * 60
+
+# Calendars that couldn't be watched (e.g. some holiday calendars can't be),
+# and channels that couldn't be stopped, are tried again after this long
+RETRY_INTERVAL = 15 * 60
+
+# Resource states sent by Google; 'sync' only confirms a new channel
+CHANGED_RESOURCE_STATES = ['exists', 'not_exists']
+
+
+class NotificationReceiver():
+
+    def __init__(self, host, port, token):
+        self.token = token
+        self._queue = queue.Queue()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+        self.running = False
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self._server.shutdown()
+            self._server.server_close()
+            self._queue.put(None)
+
+    def wait(self, timeout):
+        try:
+            notifications = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                notifications.append(self._queue.get_nowait())
+            except queue.Empty:
+                return [notification for notification in notifications if notification is not None]
+
+    def _handler_class(self):
+        receiver = self
+
+        class NotificationHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                # Always acknowledge, Google retries (with backoff) on errors
+                self.send_response(200)
+                self.end_headers()
+
+                if self.headers.get('X-Goog-Channel-Token') != receiver.token:
+                    return
+                state = self.headers.get('X-Goog-Resource-State')
+                if state in CHANGED_RESOURCE_STATES:
+                    receiver._queue.put(self.headers.get('X-Goog-Channel-ID'))
+
+            def log_message(self, format, *args):
+                pass
+
+        return NotificationHandler
+
+
+class Channel():
+
+    def __init__(self, id, cal_id, resource_id, expiration):
+        self.id = id
+        self.cal_id = cal_id
+        self.resource_id = resource_id
+        self.expiration = expiration
+        self.retry_at = 0
+
+
+class ChannelManager():
+
+    def __init__(self, google_apis, address, token, renew_margin=RENEW_MARGIN, retry_interval=RETRY_INTERVAL):
+        self._google_apis = google_apis
+        self._address = address
+        self._token = token
+        self._renew_margin = renew_margin
+        self._retry_interval = retry_interval
+        self._channels = {}
+        # Channels replaced or no longer wanted, until they're stopped (they
+        # still deliver notifications until then)
+        self._stale_channels = {}
+        self._watch_retries = {}
+
+    def ensure_channels(self, cal_ids, credentials, now=None):
+        # Failures are logged and retried later, rather than raised: a
+        # calendar that can't be watched must not stop the others from being
+        now = now if now is not None else time.time()
+        watched = {channel.cal_id: channel for channel in self._channels.values()}
+
+        for cal_id in [None] + sorted(cal_ids):
+            channel = watched.pop(cal_id, None)
+            if channel is not None and channel.expiration - self._renew_margin > now:
+                continue
+            if channel is not None and channel.expiration <= now:
+                del self._channels[channel.id]  # Expired, nothing to stop
+                channel = None
+            if self._watch_retries.get(cal_id, 0) > now:
+                continue
+            if self._watch(cal_id, credentials, now) and channel is not None:
+                self._retire(channel)
+
+        for channel in watched.values():
+            self._retire(channel)
+        for cal_id in list(self._watch_retries):
+            if cal_id is not None and cal_id not in cal_ids:
+                del self._watch_retries[cal_id]
+
+        for channel in list(self._stale_channels.values()):
+            if channel.expiration <= now:
+                del self._stale_channels[channel.id]
+            elif channel.retry_at <= now and not self._stop(channel, credentials):
+                channel.retry_at = now + self._retry_interval
+
+    def next_renewal(self):
+        times = [channel.expiration - self._renew_margin for channel in self._channels.values()]
+        times += [channel.retry_at for channel in self._stale_channels.values()]
+        times += list(self._watch_retries.values())
+        return min(times) if times else None
+
+    def resolve(self, channel_id):
+        channel = self._channels.get(channel_id) or self._stale_channels.get(channel_id)
+        if channel is None:
+            return (False, None)
+        return (True, channel.cal_id)
+
+    def stop_all(self, credentials):
+        for channel in list(self._channels.values()):
+            self._retire(channel)
+        for channel in list(self._stale_channels.values()):
+            self._stop(channel, credentials)
+
+    def _watch(self, cal_id, credentials, now):
+        channel_id = str(uuid.uuid4())
+        name = "calendar list" if cal_id is None else f"calendar '{cal_id}'"
+        try:
+            if cal_id is None:
+                response = self._google_apis.watch_cal_list(channel_id, self._address, self._token, credentials)
+            else:
+                response = self._google_apis.watch_cal_events(
+                    cal_id, channel_id, self._address, self._token, credentials)
+        except Exception as e:
+            print(f"WARNING: Cannot watch {name} for changes, retrying later: {type(e).__name__}: {e}")
+            self._watch_retries[cal_id] = now + self._retry_interval
+            return False
+        print(f"Watching {name} for changes")
+        self._watch_retries.pop(cal_id, None)
+        self._channels[channel_id] = Channel(
+            channel_id, cal_id, response['resourceId'], int(response['expiration']) / 1000)
+        return True
+
+    def _retire(self, channel):
+        del self._channels[channel.id]
+        self._stale_channels[channel.id] = channel
+
+    def _stop(self, channel, credentials):
+        # Only forgotten once stopped, so that stopping is retried on failure
+        try:
+            self._google_apis.stop_channel(channel.id, channel.resource_id, credentials)
+        except Exception as e:
+            print(f"WARNING: Cannot stop channel '{channel.id}': {type(e).__name__}: {e}")
+            return False
+        del self._stale_channels[channel.id]
+        return True
@@ -0,0 +1,188 @@
+import hashlib
+from datetime import datetime, timedelta
+from gcalvault.gcalvault import GoogleApis
+
+# Deterministic generators for large calendar lists and iCal/ICS exports, used
+# by the scale tests. The same arguments always produce the same output, and
+# each revision of a calendar changes a predictable subset of its events.
+
+
+TIMEZONES = ["America/Los_Angeles", "America/New_York", "Europe/London", "Asia/Tokyo"]
+ACCESS_ROLES = ["owner", "writer", "reader"]
+WORDS = [
+    "planning", "review", "standup", "sync", "dentist", "lunch", "budget", "launch",
+    "interview", "retro", "offsite", "training", "demo", "design", "roadmap", "hiring",
+]
+BASE_TIME = datetime(2015, 1, 5, 8, 0, 0)
+
+
+def calendar_ids(count):
+    return [f"cal{i:05d}@group.calendar.google.com" for i in range(count)]
+
+
+def calendar_list(count, revision=0, changed_every=10):
+    """Google Calendar API calendarList response for `count` calendars; at each
+    revision, the etag of every `changed_every`-th calendar changes."""
+    items = []
+    for (i, cal_id) in enumerate(calendar_ids(count)):
+        items.append({
+            "kind": "calendar#calendarListEntry",
+            "etag": f'"{_changes_until(i, revision, changed_every)}"',
+            "id": cal_id,
+            "summary": f"Calendar {i}",
+            "timeZone": TIMEZONES[i % len(TIMEZONES)],
+            "accessRole": ACCESS_ROLES[i % len(ACCESS_ROLES)],
+        })
+    return {"kind": "calendar#calendarList", "etag": f'"list{revision}"', "items": items}
+
+
+def changed_calendar_ids(count, revision, changed_every=10):
+    if revision == 0:
+        return calendar_ids(count)
+    return [cal_id for (i, cal_id) in enumerate(calendar_ids(count)) if i % changed_every == revision % changed_every]
+
+
+def calendar_revision(cal_id, revision, changed_every=10):
+    """Number of times a calendar of `calendar_list` changed up to `revision`,
+    which is the revision its content is served at."""
+    return _changes_until(int(cal_id[len("cal"):cal_id.index("@")]), revision, changed_every)
+
+
+def calendar_ics(cal_id, event_count, revision=0, changed_every=100):
+    return "".join(iter_calendar_ics(cal_id, event_count, revision, changed_every))
+
+
+def iter_calendar_ics(cal_id, event_count, revision=0, changed_every=100):
+    """Yields an iCal/ICS export of `cal_id` with `event_count` events, one
+    component at a time. At each revision, every `changed_every`-th event
+    (offset by the revision) is modified."""
+    tzid = TIMEZONES[_seed(cal_id) % len(TIMEZONES)]
+    yield (
+        "BEGIN:VCALENDAR\r\n"
+        "PRODID:-//Google Inc//Google Calendar 70.9054//EN\r\n"
+        "VERSION:2.0\r\n"
+        "CALSCALE:GREGORIAN\r\n"
+        f"X-WR-CALNAME:{cal_id}\r\n"
+        f"X-WR-TIMEZONE:{tzid}\r\n"
+        "BEGIN:VTIMEZONE\r\n"
+        f"TZID:{tzid}\r\n"
+        "BEGIN:STANDARD\r\n"
+        "TZOFFSETFROM:+0000\r\n"
+        "TZOFFSETTO:+0000\r\n"
+        "DTSTART:19700101T000000\r\n"
+        "END:STANDARD\r\n"
+        "END:VTIMEZONE\r\n"
+    )
+    for i in range(event_count):
+        yield _event(cal_id, tzid, i, _changes_until(i, revision, changed_every))
+    yield "END:VCALENDAR\r\n"
+
+
+def modified_event_count(event_count, revision, changed_every=100):
+    if revision == 0:
+        return 0
+    return len(range(revision % changed_every, event_count, changed_every))
+
+
+class SyntheticGoogleApis(GoogleApis):
+    """GoogleApis serving synthetic calendars; set `revision` to move the
+    account forward in time. Content is generated ahead of time by `prepare`,
+    so that generating it is not measured as part of a sync."""
+
+    def __init__(self, calendar_count, event_count, revision=0):
+        super().__init__()
+        self.calendar_count = calendar_count
+        self.event_count = event_count
+        self.revision = revision
+        self.downloaded = []
+        self._icals = {}
+
+    def prepare(self):
+        for cal_id in calendar_ids(self.calendar_count):
+            self._ical(cal_id)
+
+    def request_cal_list(self, credentials):
+        return calendar_list(self.calendar_count, self.revision)
+
+    def request_cal_as_ical(self, cal_id, credentials):
+        self.downloaded.append(cal_id)
+        return self._ical(cal_id)
+
+    def _ical(self, cal_id):
+        cal_revision = calendar_revision(cal_id, self.revision)
+        if self._icals.get(cal_id, (None,))[0] != cal_revision:
+            self._icals[cal_id] = (cal_revision, calendar_ics(cal_id, self.event_count, cal_revision))
+        return self._icals[cal_id][1]
+
+
+def _event(cal_id, tzid, i, event_revision):
+    rng = _Choices(f"{cal_id}/{i}/{event_revision}")
+    start = BASE_TIME + timedelta(days=i // 8, hours=i % 8)
+    stamp = BASE_TIME + timedelta(days=i // 8 + event_revision)
+    summary = " ".join(rng.choice(WORDS) for _ in range(3)).capitalize()
+    lines = []
+    if i % 5 == 0:
+        lines.append(f"DTSTART;VALUE=DATE:{start:%Y%m%d}")
+        lines.append(f"DTEND;VALUE=DATE:{start + timedelta(days=1):%Y%m%d}")
+    else:
+        lines.append(f"DTSTART;TZID={tzid}:{start:%Y%m%dT%H%M%S}")
+        lines.append(f"DTEND;TZID={tzid}:{start + timedelta(minutes=30 * rng.randint(1, 4)):%Y%m%dT%H%M%S}")
+    if i % 7 == 0:
+        lines.append(f"RRULE:FREQ=WEEKLY;COUNT={rng.randint(2, 52)}")
+    lines.append(f"DTSTAMP:{stamp:%Y%m%dT%H%M%SZ}")
+    lines.append(f"UID:{_seed(f'{cal_id}/{i}'):016x}@synthetic.gcalvault")
+    lines.append(f"CREATED:{BASE_TIME:%Y%m%dT%H%M%SZ}")
+    # Long enough to be folded across lines, with characters that must be escaped
+    description = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 30)))
+    lines.append(f"DESCRIPTION:{description}\\, revision {event_revision}\\nSee agenda")
+    lines.append(f"LAST-MODIFIED:{stamp:%Y%m%dT%H%M%SZ}")
+    lines.append(f"LOCATION:Room {rng.randint(1, 500)}")
+    if i % 3 == 0:
+        lines.append(f"ORGANIZER;CN=Organizer {i % 50}:mailto:organizer{i % 50}@example.com")
+        for n in range(rng.randint(1, 5)):
+            lines.append(
+                f'ATTENDEE;CUTYPE=INDIVIDUAL;ROLE=REQ-PARTICIPANT;PARTSTAT=ACCEPTED;CN="Attendee {n}, Example":'
+                f"mailto:attendee{n}@example.com")
+    lines.append(f"SEQUENCE:{event_revision}")
+    lines.append("STATUS:CONFIRMED")
+    lines.append(f"SUMMARY:{summary}")
+    lines.append("TRANSP:OPAQUE")
+    return "BEGIN:VEVENT\r\n" + "".join(_fold(line) for line in lines) + "END:VEVENT\r\n"
+
+
+def _changes_until(i, revision, changed_every):
+    # Number of revisions (up to and including `revision`) that changed item i,
+    # where item i changes at every revision r with r % changed_every == i % changed_every
+    if revision == 0:
+        return 0
+    first = i % changed_every or changed_every
+    return 0 if first > revision else (revision - first) // changed_every + 1
+
+
+class _Choices():
+    # Much cheaper to set up than a seeded random.Random, which matters when
+    # generating hundreds of thousands of events
+
+    def __init__(self, text):
+        self._digest = hashlib.sha256(text.encode('utf-8')).digest()
+        self._pos = 0
+
+    def _next(self):
+        value = self._digest[self._pos % len(self._digest)] + self._pos // len(self._digest)
+        self._pos += 1
+        return value
+
+    def choice(self, values):
+        return values[self._next() % len(values)]
+
+    def randint(self, low, high):
+        return low + self._next() % (high - low + 1)
+
+
+def _fold(line, width=75):
+    chunks = [line[:width]] + [" " + line[pos:pos + width - 1] for pos in range(width, len(line), width - 1)]
+    return "".join(f"{chunk}\r\n" for chunk in chunks)
+
+
+def _seed(text):
+    return int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'big')
@@ -4,11 +4,31 @@ import json
 from pathlib import Path
 import shutil
 import glob
+import time
+import pstats
+import tracemalloc
+import asyncio
+import urllib.request
+import threading
 import pytest
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock
 from git import Repo
+import gcalvault.gcalvault
 from gcalvault import Gcalvault, GcalvaultError
 from gcalvault.gcalvault import GoogleOAuth2, GoogleApis
+from gcalvault.event_diff import diff_events
+from gcalvault.history_index import HistoryIndex
+from gcalvault.ical import iter_events
+from gcalvault.columnar_export import ColumnarExporter
+from gcalvault.credential_manager import CredentialManager
+from gcalvault.etag_manager import ETagManager
+from gcalvault.git_vault_repo import replay_deferred_commit
+from gcalvault.lease import Lease
+from gcalvault.profiler import Profiler
+from gcalvault.poll_schedule import PollSchedule, MIN_INTERVAL, MAX_INTERVAL, CALENDAR_LIST_KEY
+from gcalvault.push_notifications import NotificationReceiver, ChannelManager
+from google.oauth2.credentials import Credentials
 
 # Note: Tests are meant to run in a container (see `make test`), so
 # tests here are written against the actual file system, including
@@ -28,6 +48,19 @@ data_dir_path = os.path.join(dirname, "data")
         ["--export-only"],  # valid option with no command
         ["noop"],  # valid command with no user
         ["noop", "foo.bar@gmail.com", "--ignore-role"],  # opt requiring value not provided
+        ["noop", "foo.bar@gmail.com", "--git-engine", "bad"],  # invalid git engine
+        ["watch", "foo.bar@gmail.com"],  # watch without webhook url
+        ["noop", "foo.bar@gmail.com", "--since", "yesterday"],  # invalid window
+        ["noop", "foo.bar@gmail.com", "--until", "2021-13-01"],  # invalid window
+        ["search", "--query", "evening", "--on", "June 30"],  # invalid date
+        ["export", "foo.bar@gmail.com"],  # export without export dir
+        ["noop", "foo.bar@gmail.com", "--format", "csv"],  # invalid export format
+        ["noop", "foo.bar@gmail.com", "--shard", "4/4"],  # shard index out of range
+        ["noop", "foo.bar@gmail.com", "--shard", "1"],  # invalid shard
+        ["noop", "foo.bar@gmail.com", "--concurrency", "0"],  # invalid concurrency
+        ["noop", "foo.bar@gmail.com", "--concurrency", "many"],  # invalid concurrency
+        ["noop", "foo.bar@gmail.com", "--processes", "0"],  # invalid processes
+        ["fleet"],  # fleet without users
     ])
 def test_invalid_args(args):
     gc = Gcalvault()
@@ -81,6 +114,34 @@ def test_version(capsys, args):
             {'ignore_roles': ["reader"]}),
         (["noop", "foo.bar@gmail.com", "-i", "reader", "-i", "writer"],
             {'ignore_roles': ["reader", "writer"]}),
+        (["noop", "foo.bar@gmail.com", "--git-engine", "fast-import"],
+            {'git_engine': "fast-import"}),
+        (["noop", "foo.bar@gmail.com", "--index"],
+            {'index': True}),
+        (["noop", "foo.bar@gmail.com", "--query", "Evening event", "--on", "2021-06-15"],
+            {'query': "Evening event", 'on': "2021-06-15"}),
+        (["noop", "foo.bar@gmail.com", "--changes-file", "/tmp/changes.json"],
+            {'changes_file': "/tmp/changes.json"}),
+        (["noop", "foo.bar@gmail.com", "--async", "--concurrency", "32"],
+            {'use_async': True, 'concurrency': 32}),
+        (["noop", "foo.bar@gmail.com", "--adaptive", "--full"],
+            {'adaptive': True, 'full': True}),
+        (["noop", "foo.bar@gmail.com", "--webhook-url", "https://example.com/hook", "--listen", "127.0.0.1:9000"],
+            {'webhook_url': "https://example.com/hook", 'listen': "127.0.0.1:9000"}),
+        (["noop", "foo.bar@gmail.com", "--since", "2Y", "--until", "2021-01-01"],
+            {'since': "2y", 'until': "2021-01-01"}),
+        (["noop", "foo.bar@gmail.com", "--export-dir", "/tmp/export", "--format", "Arrow"],
+            {'export_dir': "/tmp/export", 'export_format': "arrow"}),
+        (["noop", "foo.bar@gmail.com", "--profile"],
+            {'profile': True, 'profile_memory': False}),
+        (["noop", "foo.bar@gmail.com", "--profile-memory"],
+            {'profile': True, 'profile_memory': True}),
+        (["noop", "foo.bar@gmail.com", "--shard", "1/4"],
+            {'shard': (1, 4)}),
+        (["noop", "foo.bar@gmail.com", "--users-file", "/tmp/users.txt"],
+            {'users_file': "/tmp/users.txt"}),
+        (["noop", "foo.bar@gmail.com", "--processes", "4"],
+            {'processes': 4}),
         (["noop", "foo.bar@gmail.com", "-c", "/tmp/conf"],
             {'conf_dir': "/tmp/conf"}),
         (["noop", "foo.bar@gmail.com", "--conf-dir", "/tmp/conf"],
@@ -356,6 +417,103 @@ def test_etags_some_added():
     _assert_ics_files_match(output_dir, expected_files_after)
 
 
+@pytest.mark.parametrize("git_engine", ["index", "fast-import"])
+def test_etag_changed_content_unchanged(capsys, git_engine):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--git-engine", git_engine, "-c", conf_dir, "-o", output_dir])
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    mtime_ns = os.stat(cal_file_path).st_mtime_ns
+    capsys.readouterr()
+
+    # The calendar's etag changes, but its content doesn't
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less_alt_etag"))
+    gc.run(["sync", "foo.bar@gmail.com", "--git-engine", git_engine, "-c", conf_dir, "-o", output_dir])
+
+    output = capsys.readouterr().out
+    assert "Downloading calendar 'foo.bar@gmail.com'" in output
+    assert "Calendar 'foo.bar@gmail.com' is unchanged" in output
+    assert "Adding" not in output
+    assert os.stat(cal_file_path).st_mtime_ns == mtime_ns
+    _assert_git_repo_state(output_dir, commit_count=2)
+
+
+@pytest.mark.parametrize("hash_file_state", ["missing", "truncated"])
+def test_content_unchanged_without_recorded_hash(capsys, hash_file_state):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    hash_file_path = Path(conf_dir, "foo.bar@gmail.com.hashes")
+    if hash_file_state == "missing":  # e.g. synced by a previous version
+        os.remove(hash_file_path)
+    else:  # crashed while writing it
+        content = hash_file_path.read_text()
+        hash_file_path.write_text(content[:content.index("foo.bar@gmail.com.ics\t") + 30])
+    capsys.readouterr()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less_alt_etag"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert "Calendar 'foo.bar@gmail.com' is unchanged" in capsys.readouterr().out
+    assert "foo.bar@gmail.com.ics\t" in Path(conf_dir, "foo.bar@gmail.com.hashes").read_text()
+
+
+def test_content_unchanged_but_not_committed(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-e", "-c", conf_dir, "-o", output_dir])
+    capsys.readouterr()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less_alt_etag"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    output = capsys.readouterr().out
+    assert "Calendar 'foo.bar@gmail.com' is unchanged" in output
+    assert "Adding foo.bar@gmail.com.ics" in output
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=1)
+
+
+def test_clean_verifies_files(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    with open(os.path.join(output_dir, "family123456789@group.calendar.google.com.ics"), 'a') as file:
+        file.write("corrupted")
+    os.utime(os.path.join(output_dir, "foo.bar@gmail.com.ics"))  # Touched, but not modified
+    capsys.readouterr()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--clean", "-c", conf_dir, "-o", output_dir])
+
+    output = capsys.readouterr().out
+    assert "WARNING: File 'family123456789@group.calendar.google.com.ics' does not match" in output
+    assert "Saved calendar 'family123456789@group.calendar.google.com'" in output
+    assert "Saved calendar 'foo.bar@gmail.com'" not in output
+    _assert_ics_file_content_match(output_dir, "family123456789@group.calendar.google.com.ics")
+    _assert_git_repo_state(output_dir, commit_count=2)
+    assert not Repo(output_dir).is_dirty()
+
+
 def test_sync_export_only():
     (conf_dir, output_dir) = _setup_dirs()
 
@@ -390,12 +548,1185 @@ def test_git_commits():
     _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)  # initial commit + 1, 4 ics files
 
 
+@pytest.mark.parametrize("git_engine", ["index", "fast-import"])
+def test_git_engines_clean(git_engine):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "--git-engine", git_engine, "-c", conf_dir, "-o", output_dir])
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list='less_alt_etag', cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "--clean", "--git-engine", git_engine, "-c", conf_dir, "-o", output_dir])
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=3)  # 1 modified, 2 removed
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list='less_alt_etag', cal_files={}, cal_files_as_allowlist=True))
+    gc.run(["sync", "foo.bar@gmail.com", "--git-engine", git_engine, "-c", conf_dir, "-o", output_dir])
+    _assert_git_repo_state(output_dir, commit_count=3)  # nothing changed
+
+    repo = Repo(output_dir)
+    assert not repo.is_dirty(untracked_files=True)
+    assert sorted(blob.path for blob in repo.head.commit.tree.blobs) == [
+        ".gitignore",
+        "family123456789@group.calendar.google.com.ics",
+        "foo.bar@gmail.com.ics",
+    ]
+
+
+def test_git_engines_produce_same_history(monkeypatch):
+    monkeypatch.setenv("GIT_AUTHOR_DATE", "2021-01-01T12:00:00+0200")
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "1609459200 -0500")
+    histories = []
+    for git_engine in ["index", "fast-import"]:
+        (conf_dir, output_dir) = _setup_dirs()
+        for cal_list in [None, 'less_alt_etag']:
+            gc = Gcalvault(
+                google_oauth2=_get_google_oauth2_mock(),
+                google_apis=_get_google_apis_mock(cal_list=cal_list, cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"} if cal_list else {}))
+            gc.run(["sync", "foo.bar@gmail.com", "--clean", "--git-engine", git_engine, "-c", conf_dir, "-o", output_dir])
+        repo = Repo(output_dir)
+        histories.append([
+            (commit.hexsha, commit.tree.hexsha, commit.message,
+             commit.authored_date, commit.author_tz_offset, commit.committed_date, commit.committer_tz_offset)
+            for commit in repo.iter_commits()])
+    assert len(histories[0]) == 3
+    assert histories[0] == histories[1]
+    assert Repo(output_dir).head.commit.committed_date == 1609459200
+
+
+def test_show(capsysbinary, monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "1609459200 +0000")
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "1622505600 +0000")
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    capsysbinary.readouterr()
+
+    for (at, data_file_name) in [
+            ("2021-03-01", "foo.bar@gmail.com.ics"),
+            ("2021-05-31T23:59:59Z", "foo.bar@gmail.com.ics"),
+            ("2021-06-01", "foo.bar@gmail.com_alt.ics"),  # end of the day of the second sync
+            ("2021-06-01T00:00:00Z", "foo.bar@gmail.com_alt.ics"),
+            ("HEAD~1", "foo.bar@gmail.com.ics"),
+            (None, "foo.bar@gmail.com_alt.ics")]:
+        gc = Gcalvault()
+        gc.run(["show", "foo.bar@gmail.com", "foo.bar@gmail.com", "-o", output_dir] + (["--at", at] if at else []))
+        assert capsysbinary.readouterr().out.decode('utf-8') == _read_data_file(data_file_name)
+
+
+def test_show_concurrent_refreshes():
+    (conf_dir, output_dir) = _setup_dirs()
+    for cal_list in ["less", "less_alt_etag"]:
+        gc = Gcalvault(
+            google_oauth2=_get_google_oauth2_mock(),
+            google_apis=_get_google_apis_mock(
+                cal_list=cal_list,
+                cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"} if cal_list == "less_alt_etag" else {}))
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    threads = [threading.Thread(target=HistoryIndex(output_dir).refresh) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    entries_file_path = os.path.join(output_dir, ".git", "gcalvault", "history", "foo.bar@gmail.com.ics")
+    lines = Path(entries_file_path).read_text().splitlines()
+    assert len(lines) == 2 and len(set(lines)) == 2
+
+    # Entries repeated by an interrupted refresh are ignored
+    Path(entries_file_path).write_text("\n".join(lines + lines) + "\n")
+    history = HistoryIndex(output_dir)
+    assert len(history._read_entries("foo.bar@gmail.com.ics")) == 2
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ["foo.bar@gmail.com", "--at", "2020-12-30"],  # before first commit
+        ["foo.bar@gmail.com", "--at", "badrev"],  # unknown revision
+        ["foo.baz@gmail.com"],  # calendar never synced
+        [],  # no calendar
+    ])
+def test_show_not_found(args):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcalvault()
+    with pytest.raises(GcalvaultError):
+        gc.run(["show", "foo.bar@gmail.com", "-o", output_dir] + args)
+
+
+def test_search(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--index", "-c", conf_dir, "-o", output_dir])
+    assert capsys.readouterr().out.count("Indexed calendar") == 2
+
+    def search(*args):
+        gc = Gcalvault()
+        gc.run(["search", "foo.bar@gmail.com", "-c", conf_dir] + list(args))
+        return [line.split("\t") for line in capsys.readouterr().out.splitlines()]
+
+    results = search("--query", "evening")
+    assert len(results) == 4
+    assert results[0][:3] == ["2021-06-15T17:00:00", "2021-06-15T17:30:00", "family123456789@group.calendar.google.com"]
+
+    results = search("--query", "evening #2", "--on", "2021-07-01")
+    assert [result[2] for result in results] == ["family123456789@group.calendar.google.com", "foo.bar@gmail.com"]
+
+    assert len(search("foo.bar@gmail.com", "--on", "2021-06-14")) == 2
+    assert len(search("--query", "nonexistent")) == 0
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "--index", "-c", conf_dir, "-o", output_dir])
+    assert capsys.readouterr().out.count("Indexed calendar") == 1  # only the changed calendar
+
+    assert len(search("foo.bar@gmail.com", "--query", "evening")) == 0
+    assert len(search("foo.bar@gmail.com", "--query", "weekly")) == 1
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="empty"))
+    gc.run(["sync", "foo.bar@gmail.com", "--index", "--clean", "-c", conf_dir, "-o", output_dir])
+    capsys.readouterr()
+    assert len(search("--query", "weekly")) == 0
+
+
+def test_search_all_users(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    for user in ["foo.bar@gmail.com", "foo.baz@gmail.com"]:
+        gc = Gcalvault(
+            google_oauth2=_get_google_oauth2_mock(email=user),
+            google_apis=_get_google_apis_mock(cal_list="less"))
+        gc.run(["sync", user, "--index", "-c", conf_dir, "-o", os.path.join(output_dir, user)])
+    capsys.readouterr()
+
+    gc = Gcalvault()
+    gc.run(["search", "--query", "evening #2", "--on", "2021-07-01", "-c", conf_dir])
+    results = [line.split("\t") for line in capsys.readouterr().out.splitlines()]
+    assert sorted(result[0] for result in results) == \
+        ["foo.bar@gmail.com", "foo.bar@gmail.com", "foo.baz@gmail.com", "foo.baz@gmail.com"]
+    assert results[0][1:4] == ["2021-07-01T17:00:00", "2021-07-01T17:30:00", "family123456789@group.calendar.google.com"]
+
+
+def test_event_days():
+    ical = "\r\n".join([
+        "BEGIN:VCALENDAR",
+        "X-WR-TIMEZONE:America/Los_Angeles",
+        "BEGIN:VTIMEZONE",
+        "TZID:Europe/Paris",
+        "END:VTIMEZONE",
+        "BEGIN:VEVENT",
+        "DTSTART:20210701T020000Z",  # evening of June 30 in Los Angeles
+        "DTEND:20210701T030000Z",
+        "END:VEVENT",
+        "BEGIN:VEVENT",
+        "DTSTART;TZID=Europe/Paris:20210630T230000",
+        "DTEND;TZID=Europe/Paris:20210701T000000",
+        "END:VEVENT",
+        "BEGIN:VEVENT",
+        "DTSTART;VALUE=DATE:20210630",
+        "DTEND;VALUE=DATE:20210702",
+        "END:VEVENT",
+        "END:VCALENDAR",
+        ""])
+    calendar_properties = {}
+    days = [event.days(calendar_properties.get('X-WR-TIMEZONE')) for event in iter_events(ical, calendar_properties)]
+    assert calendar_properties == {'X-WR-TIMEZONE': "America/Los_Angeles"}
+    assert days == [("2021-06-30", "2021-06-30"), ("2021-06-30", "2021-06-30"), ("2021-06-30", "2021-07-01")]
+
+
+def test_search_without_index():
+    (conf_dir, _) = _setup_dirs()
+
+    gc = Gcalvault()
+    with pytest.raises(GcalvaultError):
+        gc.run(["search", "foo.bar@gmail.com", "--query", "evening", "-c", conf_dir])
+
+
+def test_sync_changes():
+    (conf_dir, output_dir) = _setup_dirs()
+    changes_file = os.path.join(conf_dir, "changes.json")
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--changes-file", changes_file, "-c", conf_dir, "-o", output_dir])
+    changes = json.loads(_read_file(conf_dir, "changes.json"))
+    assert changes['user'] == "foo.bar@gmail.com"
+    assert [len(cal['added']) for cal in changes['calendars']] == [4, 4]
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "--changes-file", changes_file, "-c", conf_dir, "-o", output_dir])
+    changes = json.loads(_read_file(conf_dir, "changes.json"))
+    assert len(changes['calendars']) == 1
+    assert changes['calendars'][0]['calendar_id'] == "foo.bar@gmail.com"
+    assert (len(changes['calendars'][0]['added']), len(changes['calendars'][0]['modified'])) == (0, 0)
+    assert sorted(event['summary'] for event in changes['calendars'][0]['deleted']) == [
+        "Daily recurring", "Evening event #1", "Evening event #2"]
+
+    message = Repo(output_dir).head.commit.message
+    assert message.startswith("gcalvault sync\n\nfoo.bar@gmail.com: 0 added, 0 modified, 3 deleted event(s)\n")
+    assert "  - aff00610-8acd-4e40-a748-26300da24c85 Daily recurring" in message
+
+
+def test_event_diff():
+    def ics(*events):
+        lines = ["BEGIN:VCALENDAR"]
+        for (uid, recurrence_id, seq, stamp, summary) in events:
+            lines += ["BEGIN:VEVENT", f"UID:{uid}"]
+            lines += [f"RECURRENCE-ID:{recurrence_id}"] if recurrence_id else []
+            lines += [f"SEQUENCE:{seq}", f"DTSTAMP:{stamp}", f"SUMMARY:{summary}"]
+            lines += ["BEGIN:VALARM", "ACTION:DISPLAY", "END:VALARM", "END:VEVENT"]
+        lines += ["END:VCALENDAR"]
+        return "".join(line + "\r\n" for line in lines)
+
+    old = ics(
+        ("a", "", 0, "20210101T000000Z", "Unchanged"),
+        ("b", "", 0, "20210101T000000Z", "Sequence bumped"),
+        ("c", "", 0, "20210101T000000Z", "Summary edited"),
+        ("d", "", 0, "20210101T000000Z", "Deleted"),
+        ("e", "", 0, "20210101T000000Z", "Recurring"))
+    new = ics(
+        ("a", "", 0, "20220101T000000Z", "Unchanged"),
+        ("b", "", 1, "20210101T000000Z", "Sequence bumped"),
+        ("c", "", 0, "20210101T000000Z", "Summary edited again"),
+        ("e", "", 0, "20210101T000000Z", "Recurring"),
+        ("e", "20210601T000000Z", 0, "20210101T000000Z", "Recurring exception"),
+        ("f", "", 0, "20210101T000000Z", "Added"))
+
+    diff = diff_events("cal", old, new)
+    assert [(uid, recurrence_id) for (uid, recurrence_id, _) in diff.added] == [("e", "20210601T000000Z"), ("f", "")]
+    assert [uid for (uid, _, _) in diff.modified] == ["b", "c"]
+    assert [uid for (uid, _, _) in diff.deleted] == ["d"]
+    assert diff.message_lines(max_events=2) == [
+        "cal: 2 added, 2 modified, 1 deleted event(s)",
+        "  + e (20210601T000000Z) Recurring exception",
+        "  + f Added",
+        "  ... and 3 more",
+    ]
+    assert not diff_events("cal", old, old)
+
+
+def test_credentials_refreshed_ahead_of_expiry(monkeypatch):
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    token_file_path = str(conf_dir / "foo.bar@gmail.com.token.json")
+    refreshes = _mock_credentials_refresh(monkeypatch)
+
+    manager = CredentialManager(refresh_margin=timedelta(minutes=5))
+    credentials = _get_credentials(expires_in=timedelta(hours=1))
+    assert manager.refresh_if_needed(credentials, token_file_path) is credentials
+    assert len(refreshes) == 0
+
+    credentials = _get_credentials(expires_in=timedelta(minutes=4, seconds=30))  # not yet expired, but within margin
+    assert not credentials.expired
+    refreshed = manager.refresh_if_needed(credentials, token_file_path)
+    assert len(refreshes) == 1
+    assert refreshed.token == "refreshed-1"
+
+    on_disk = json.loads(Path(token_file_path).read_text())
+    assert on_disk['token'] == "refreshed-1"
+    assert [f for f in os.listdir(conf_dir) if f.startswith(".")] == []  # no temp files left behind
+
+    # Fresh token is cached in memory for later users of the same token file
+    assert CredentialManager().load(token_file_path, None) is refreshed
+
+
+def test_credentials_concurrent_refreshes_coalesced(monkeypatch):
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    token_file_path = str(conf_dir / "foo.bar@gmail.com.token.json")
+    refreshes = _mock_credentials_refresh(monkeypatch, delay=0.2)
+
+    manager = CredentialManager()
+    credentials = _get_credentials(expires_in=timedelta(seconds=-1))
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(manager.refresh_if_needed(credentials, token_file_path)))
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(refreshes) == 1
+    assert [result.token for result in results] == ["refreshed-1"] * 8
+
+
+def _get_credentials(expires_in):
+    return Credentials(
+        token="original", refresh_token="refresh", client_id="id", client_secret="secret",
+        token_uri="https://oauth2.googleapis.com/token",
+        expiry=datetime.now(timezone.utc).replace(tzinfo=None) + expires_in)
+
+
+def _mock_credentials_refresh(monkeypatch, delay=0):
+    refreshes = []
+
+    def refresh(self, request):
+        time.sleep(delay)
+        refreshes.append(self)
+        self.token = f"refreshed-{len(refreshes)}"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+    monkeypatch.setattr(Credentials, "refresh", refresh)
+    monkeypatch.setattr(CredentialManager, "_cache", {})
+    return refreshes
+
+
+def test_sync_async():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    async_google_apis = _get_async_google_apis_mock()
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        async_google_apis=async_google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "--async", "--concurrency", "3", "-c", conf_dir, "-o", output_dir])
+
+    expected_files = [
+        "foo.bar@gmail.com.ics",
+        "foo.baz@gmail.com.ics",
+        "family123456789@group.calendar.google.com.ics",
+        "en.usa#holiday@group.v.calendar.google.com.ics",
+    ]
+    _assert_ics_files_match(output_dir, expected_files)
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)
+    assert async_google_apis.max_in_flight == 3
+
+
+def test_sync_async_download_failure(capsys, monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    save_threads = set()
+    save_calendar = Gcalvault._save_calendar
+
+    def _save_calendar(self, calendar, ical):
+        save_threads.add(threading.current_thread().name)
+        save_calendar(self, calendar, ical)
+    monkeypatch.setattr(Gcalvault, "_save_calendar", _save_calendar)
+
+    async_google_apis = _get_async_google_apis_mock()
+    request_cal_as_ical = async_google_apis.request_cal_as_ical
+    failing = {"family123456789@group.calendar.google.com", "foo.baz@gmail.com"}
+
+    async def failing_request_cal_as_ical(cal_id, credentials):
+        if cal_id in failing:
+            raise ConnectionError("Connection reset")
+        return await request_cal_as_ical(cal_id, credentials)
+    async_google_apis.request_cal_as_ical = failing_request_cal_as_ical
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), async_google_apis=async_google_apis)
+    with pytest.raises(GcalvaultError, match=r"Failed to sync 2 calendar\(s\)"):
+        gc.run(["sync", "foo.bar@gmail.com", "--async", "-c", conf_dir, "-o", output_dir])
+
+    # The other calendars were still saved and committed, off the event loop
+    _assert_ics_files_match(
+        output_dir, ["foo.bar@gmail.com.ics", "en.usa#holiday@group.v.calendar.google.com.ics"])
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=2)
+    assert len(save_threads) == 1 and save_threads.pop().startswith("gcalvault-vault")
+
+    # The failed calendars weren't recorded as up to date
+    failing.clear()
+    capsys.readouterr()
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), async_google_apis=async_google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "--async", "-c", conf_dir, "-o", output_dir])
+    out = capsys.readouterr().out
+    assert "Downloading calendar 'Family'" in out and "Downloading calendar 'foo.baz@gmail.com'" in out
+    assert "Calendar 'foo.bar@gmail.com' is up to date" in out
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=2)
+
+
+def test_sync_profile():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "--profile-memory", "-c", conf_dir, "-o", output_dir])
+
+    profiles = glob.glob(os.path.join(conf_dir, "profiles", "foo.bar@gmail.com-sync-*"))
+    assert sorted(os.path.splitext(profile)[1] for profile in profiles) == \
+        [".folded", ".pstats", ".tracemalloc", ".txt"]
+    path_prefix = os.path.splitext(profiles[0])[0]
+
+    stats = pstats.Stats(f"{path_prefix}.pstats")
+    assert any(func[2] == "_save_calendar" for func in stats.stats)
+    assert len(tracemalloc.Snapshot.load(f"{path_prefix}.tracemalloc").traces) > 0
+
+    folded = {}
+    for line in Path(f"{path_prefix}.folded").read_text().splitlines():
+        (stack, ms) = line.rsplit(" ", 1)
+        folded[stack] = int(ms)
+    assert set(folded) <= {"sync", "sync;download", "sync;write", "sync;git"}
+    assert "sync;git" in folded
+
+    summary = Path(f"{path_prefix}.txt").read_text()
+    assert re.search(r"^    download +[0-9.]+s +5 call\(s\)$", summary, re.MULTILINE)
+    assert re.search(r"^    write +[0-9.]+s +4 call\(s\)$", summary, re.MULTILINE)
+    assert "Peak traced memory" in summary
+
+
+def test_sync_profile_from_env(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    monkeypatch.setenv("GCALVAULT_PROFILE", "cpu")
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), async_google_apis=_get_async_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "--async", "-c", conf_dir, "-o", output_dir])
+
+    profiles = glob.glob(os.path.join(conf_dir, "profiles", "*"))
+    assert sorted(os.path.splitext(profile)[1] for profile in profiles) == [".folded", ".pstats", ".txt"]
+    summary = Path(os.path.splitext(profiles[0])[0] + ".txt").read_text()
+    assert re.search(r"^    download +[0-9.]+s +5 call\(s\)$", summary, re.MULTILINE)
+
+
+def test_profile_concurrent_threads(tmp_path, capsys):
+    inside = threading.Barrier(2)
+
+    def profile(name):
+        with Profiler().profile(str(tmp_path / name), name):
+            inside.wait(timeout=10)
+
+    threads = [threading.Thread(target=profile, args=(f"thread{i}",)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    out = capsys.readouterr().out
+    assert out.count("Another profile is being captured") == 1
+    assert out.count("Saved profile to") == 1
+    assert len(glob.glob(str(tmp_path / "*.pstats"))) == 1
+
+    with Profiler().profile(str(tmp_path / "after"), "after"):
+        pass
+    assert os.path.exists(tmp_path / "after.pstats")
+
+
+def test_sync_lease_held():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir()
+
+    lease = Lease(os.path.join(output_dir, ".gcalvault.lease"))
+    assert lease.acquire()
+    try:
+        gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+        with pytest.raises(GcalvaultError, match=f"Another sync of 'foo.bar@gmail.com' is in progress: .* by {lease.owner} until"):
+            gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+        _assert_ics_files_match(output_dir, [])
+        # Its conf dir lease, acquired after the vault's, was never taken
+        assert not os.path.exists(os.path.join(conf_dir, "foo.bar@gmail.com.lease"))
+    finally:
+        lease.release()
+
+
+def test_sync_takes_over_expired_lease(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir()
+
+    lease_file_path = os.path.join(conf_dir, "foo.bar@gmail.com.lease")
+    with open(lease_file_path, 'w') as file:
+        json.dump({'owner': "crashed-host:1234:abcd", 'expires': time.time() - 1}, file)
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert "Took over expired lease" in capsys.readouterr().out
+    _assert_git_repo_state(output_dir, commit_count=2)
+    assert not os.path.exists(lease_file_path)
+    assert not os.path.exists(os.path.join(output_dir, ".gcalvault.lease"))
+
+
+def test_sync_lease_lost():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis = _get_google_apis_mock()
+    request_cal_as_ical = google_apis.request_cal_as_ical
+
+    def request_cal_as_ical_while_taken_over(cal_id, credentials):
+        # Another worker took the lease over, e.g. after this one stalled for longer than the TTL
+        with open(os.path.join(output_dir, ".gcalvault.lease"), 'w') as file:
+            json.dump({'owner': "other-host:1234:abcd", 'expires': time.time() + 300}, file)
+        return request_cal_as_ical(cal_id, credentials)
+    google_apis.request_cal_as_ical = request_cal_as_ical_while_taken_over
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    with pytest.raises(GcalvaultError, match="was taken over by another worker"):
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    _assert_git_repo_state(output_dir, commit_count=1)  # .gitignore only
+    # The other worker's lease is left alone
+    assert "other-host" in Path(output_dir, ".gcalvault.lease").read_text()
+
+
+def test_lease_heartbeat():
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir()
+    lease_file_path = os.path.join(conf_dir, "test.lease")
+
+    lease = Lease(lease_file_path, ttl=1, heartbeat_interval=0.05)
+    assert lease.acquire()
+    expires = lease.holder()['expires']
+    assert not Lease(lease_file_path, ttl=1).acquire()
+
+    _wait_for(lambda: lease.holder()['expires'] > expires)
+    assert lease.verify()
+
+    with open(lease_file_path, 'w') as file:
+        json.dump({'owner': "other-host:1234:abcd", 'expires': time.time() + 300}, file)
+    _wait_for(lambda: lease.lost)
+    lease.release()
+    assert lease.holder()['owner'] == "other-host:1234:abcd"
+
+
+@pytest.mark.parametrize(
+    "shard, synced", [
+        ("2/4", True),  # foo.bar@gmail.com hashes to shard 2 of 4
+        ("1/4", False),
+        ("0/1", True),
+    ])
+def test_sync_shard(capsys, shard, synced):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "--shard", shard, "-c", conf_dir, "-o", output_dir])
+
+    assert os.path.exists(output_dir) == synced
+    if not synced:
+        assert "User 'foo.bar@gmail.com' is assigned to shard 2/4, skipping" in capsys.readouterr().out
+
+
+def test_etags_per_user():
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir()
+    (conf_dir / ".etags").write_text("foo.bar@gmail.com\tabc\n")
+
+    # Each user's etags are seeded from the shared file of earlier versions
+    etags1 = ETagManager(conf_dir, "foo.bar@gmail.com")
+    etags2 = ETagManager(conf_dir, "foo.baz@gmail.com")
+    assert not etags1.test_for_change_and_save("foo.bar@gmail.com", '"abc"')
+    assert etags1.test_for_change_and_save("foo.bar@gmail.com", '"ghi"')
+    assert etags2.test_for_change_and_save("foo.baz@gmail.com", '"def"')
+    assert not etags2.test_for_change("foo.bar@gmail.com", '"abc"')
+
+    etags = ETagManager(conf_dir, "foo.bar@gmail.com")
+    assert not etags.test_for_change("foo.bar@gmail.com", '"ghi"')
+    assert etags.test_for_change("foo.baz@gmail.com", '"def"')
+    etags = ETagManager(conf_dir, "foo.baz@gmail.com")
+    assert not etags.test_for_change("foo.baz@gmail.com", '"def"')
+    assert (conf_dir / ".etags").read_text() == "foo.bar@gmail.com\tabc\n"
+
+
+def test_sync_async_many_users():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    async_google_apis = _get_async_google_apis_mock()
+
+    async def sync_users(users):
+        await asyncio.gather(*[
+            Gcalvault(google_oauth2=_get_google_oauth2_mock(email=user), async_google_apis=async_google_apis).run_async(
+                ["sync", user, "-c", conf_dir, "-o", os.path.join(output_dir, user)])
+            for user in users])
+    asyncio.run(sync_users(["foo.bar@gmail.com", "foo.baz@gmail.com"]))
+
+    for user in ["foo.bar@gmail.com", "foo.baz@gmail.com"]:
+        assert len(glob.glob(os.path.join(output_dir, user, "*.ics"))) == 4
+        _assert_git_repo_state(os.path.join(output_dir, user), commit_count=2, last_commit_file_count=4)
+    assert async_google_apis.max_in_flight > 1
+
+
+def test_fleet(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    users = ["foo.bar@gmail.com", "foo.baz@gmail.com", "foo.qux@gmail.com"]
+    os.makedirs(conf_dir)
+    for user in users:
+        Path(conf_dir, f"{user}.token.json").write_text("{}")
+    users_file = Path(conf_dir, "users.txt")
+    users_file.write_text("# Synced nightly\nFOO.BAZ@gmail.com\n\nfoo.qux@gmail.com\n")
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    gc.run(["fleet", "foo.bar@gmail.com", "foo.baz@gmail.com", "--users-file", users_file,
+            "-c", conf_dir, "-o", output_dir, "--processes", "2"])
+
+    for user in users:
+        assert len(glob.glob(os.path.join(output_dir, user, "*.ics"))) == 4
+        _assert_git_repo_state(os.path.join(output_dir, user), commit_count=2, last_commit_file_count=4)
+    captured = capsys.readouterr()
+    assert "Syncing 3 user(s)" in captured.out
+    assert "Results:\n" in captured.out
+    for user in users:
+        assert re.search(rf"  {re.escape(user)}: OK \(\d+\.\ds\)", captured.out)
+
+
+def _replay_deferred_commit_when_all_started(job):
+    # Runs in fleet's worker processes: waits for the commits of the other
+    # users to start too, recording whether they all ran at the same time
+    (vaults_dir, user) = os.path.split(job['dir_path'])
+    Path(vaults_dir, f"{user}.started").touch()
+    deadline = time.time() + 10
+    while len(glob.glob(os.path.join(vaults_dir, "*.started"))) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+    overlapped = len(glob.glob(os.path.join(vaults_dir, "*.started"))) == 3
+    Path(vaults_dir, f"{user}.overlapped").write_text(str(overlapped))
+    return replay_deferred_commit(job)
+
+
+def test_fleet_async_commits_in_parallel(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    users = ["foo.bar@gmail.com", "foo.baz@gmail.com", "foo.qux@gmail.com"]
+    os.makedirs(conf_dir)
+    for user in users:
+        Path(conf_dir, f"{user}.token.json").write_text("{}")
+
+    monkeypatch.setattr(gcalvault.gcalvault, "replay_deferred_commit", _replay_deferred_commit_when_all_started)
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), async_google_apis=_get_async_google_apis_mock())
+    gc.run(["fleet"] + users + ["--async", "-c", conf_dir, "-o", output_dir, "--processes", "3"])
+
+    for user in users:
+        _assert_git_repo_state(os.path.join(output_dir, user), commit_count=2, last_commit_file_count=4)
+        assert Path(output_dir, f"{user}.overlapped").read_text() == "True"
+
+
+def test_fleet_failure(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    os.makedirs(conf_dir)
+    Path(conf_dir, "foo.bar@gmail.com.token.json").write_text("{}")
+    users_file = Path(conf_dir, "users.txt")
+    users_file.write_text("foo.bar@gmail.com\nfoo.baz@gmail.com\n")
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    with pytest.raises(GcalvaultError, match=re.escape("Sync failed for 1 of 2 user(s)")):
+        gc.run(["fleet", "--users-file", users_file, "-c", conf_dir, "-o", output_dir, "--processes", "1"])
+
+    _assert_git_repo_state(os.path.join(output_dir, "foo.bar@gmail.com"), commit_count=2)
+    _assert_git_repo_state(os.path.join(output_dir, "foo.baz@gmail.com"), repo_exists=False)
+    captured = capsys.readouterr()
+    assert "foo.baz@gmail.com: FAILED, No access token" in captured.out
+
+
+def test_sync_adaptive(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--adaptive", "-c", conf_dir, "-o", output_dir])
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=2)
+
+    # Nothing due yet, calendar list isn't even requested
+    google_apis = _get_google_apis_mock(cal_list="less_alt_etag", cal_files={}, cal_files_as_allowlist=True)
+    google_apis.request_cal_list = MagicMock(side_effect=AssertionError)
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    capsys.readouterr()
+    gc.run(["sync", "foo.bar@gmail.com", "--adaptive", "-c", conf_dir, "-o", output_dir])
+    assert "No calendars are due" in capsys.readouterr().out
+    _assert_git_repo_state(output_dir, commit_count=2)
+
+    # Once the calendar list is due, a calendar that changed is downloaded
+    # even though it isn't due itself
+    schedule = PollSchedule(conf_dir, "foo.bar@gmail.com")
+    schedule.record_check(CALENDAR_LIST_KEY, "due", now=0)
+    schedule.save()
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"},
+            cal_files_as_allowlist=True))
+    gc.run(["sync", "foo.bar@gmail.com", "--adaptive", "-c", conf_dir, "-o", output_dir])
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=1)
+    _assert_ics_file_content_match(output_dir, "foo.bar@gmail.com.ics", "foo.bar@gmail.com_alt.ics")
+    schedule = PollSchedule(conf_dir, "foo.bar@gmail.com")
+    assert not schedule.any_due()
+
+    # Forced complete pass, with nothing due
+    capsys.readouterr()
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less_alt_etag", cal_files={}, cal_files_as_allowlist=True))
+    gc.run(["sync", "foo.bar@gmail.com", "--adaptive", "--full", "-c", conf_dir, "-o", output_dir])
+    assert capsys.readouterr().out.count("is up to date") == 2
+    _assert_git_repo_state(output_dir, commit_count=3)
+
+
+def test_poll_schedule_backoff():
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+
+    schedule = PollSchedule(conf_dir, "foo.bar@gmail.com")
+    assert schedule.is_due("dormant", now=0) and schedule.is_due("active", now=0)
+    schedule.record_calendar_list(["dormant", "active"], now=0)
+    schedule.record_check("dormant", '"etag"', now=0)
+    schedule.record_check("active", '"etag0"', now=0)
+    assert not schedule.any_due(now=MIN_INTERVAL - 1)
+    assert schedule.any_due(now=MIN_INTERVAL)
+
+    now = 0
+    for check in range(1, 20):
+        now += MIN_INTERVAL
+        schedule.record_check("active", f'"etag{check}"', now=now)
+        if schedule.is_due("dormant", now=now):
+            schedule.record_check("dormant", '"etag"', now=now)
+    assert schedule.next_check("active") == now + MIN_INTERVAL  # floor for active calendars
+    assert schedule.next_check("dormant") - now > 8 * MIN_INTERVAL  # backed off
+    schedule.save()
+
+    schedule = PollSchedule(conf_dir, "foo.bar@gmail.com")
+    for _ in range(20):
+        now = schedule.next_check("dormant")
+        schedule.record_check("dormant", '"etag"', now=now)
+    assert schedule.next_check("dormant") - now == MAX_INTERVAL
+    schedule.record_check("dormant", '"changed"', now=now)
+    assert schedule.next_check("dormant") - now == MIN_INTERVAL
+
+    schedule.record_calendar_list(["active"], now=now)  # removed calendars are dropped
+    assert schedule.next_check("dormant") == 0
+
+
+def test_poll_schedule_truncated():
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+
+    schedule = PollSchedule(conf_dir, "foo.bar@gmail.com")
+    schedule.record_calendar_list(["first", "second"], now=0)
+    schedule.record_check("first", '"etag"', now=0)
+    schedule.record_check("second", '"etag"', now=0)
+    schedule.save()
+    assert not glob.glob(os.path.join(conf_dir, ".foo.bar@gmail.com.schedule.*"))  # no leftover temp file
+
+    schedule_file_path = conf_dir / "foo.bar@gmail.com.schedule"
+    content = schedule_file_path.read_text()
+    schedule_file_path.write_text(content[:content.index("second") + 8])  # crashed while writing
+
+    schedule = PollSchedule(conf_dir, "foo.bar@gmail.com")
+    assert not schedule.is_due("first", now=1)
+    assert schedule.is_due("second", now=1)
+
+
+def test_watch():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    channels = _mock_watch_apis(google_apis)
+    downloads = []
+    cal_files = {}
+
+    def request_cal_as_ical_and_record(cal_id, credentials):
+        downloads.append(cal_id)
+        return _read_data_file(cal_files.get(cal_id, cal_id + ".ics"))
+    google_apis.request_cal_as_ical = request_cal_as_ical_and_record
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc.run(["noop", "foo.bar@gmail.com", "--webhook-url", "https://example.com/hook", "--clean",
+            "-c", conf_dir, "-o", output_dir])
+    receiver = NotificationReceiver("127.0.0.1", 0, "secret")
+    receiver.start()
+    watcher = threading.Thread(target=gc._watch, args=(receiver,))
+    watcher.start()
+    try:
+        _wait_for(lambda: len(channels) == 3)  # calendar list + 2 calendars
+        assert sorted(downloads) == ["family123456789@group.calendar.google.com", "foo.bar@gmail.com"]
+        assert all(channel['address'] == "https://example.com/hook" for channel in channels.values())
+
+        # Change shows up in the calendar list, but only the notified calendar is synced
+        downloads.clear()
+        google_apis.request_cal_list = lambda credentials: _read_data_file_json("cal_list_less_alt_etag.json")
+        cal_files["foo.bar@gmail.com"] = "foo.bar@gmail.com_alt.ics"
+        foo_bar_channel_id = next(id for (id, channel) in channels.items() if channel['cal_id'] == "foo.bar@gmail.com")
+        _post_notification(receiver, foo_bar_channel_id, "secret", "sync")  # ignored
+        _post_notification(receiver, foo_bar_channel_id, "wrong", "exists")  # ignored
+        _post_notification(receiver, foo_bar_channel_id, "secret", "exists")
+        _wait_for(lambda: len(downloads) == 1)
+        assert downloads == ["foo.bar@gmail.com"]
+    finally:
+        receiver.stop()
+        watcher.join()
+
+    assert len(channels) == 0  # channels stopped on exit
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=1)
+    # --clean only applies to full syncs, not to syncs of the notified calendars
+    _assert_ics_files_match(
+        output_dir, ["foo.bar@gmail.com.ics", "family123456789@group.calendar.google.com.ics"], check_file_content=False)
+
+
+def test_watch_failures(capsys, monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    monkeypatch.setattr("gcalvault.gcalvault.WATCH_POLL_INTERVAL", 0.1)
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    channels = _mock_watch_apis(google_apis)
+    watch_cal_events = google_apis.watch_cal_events
+
+    def watch_cal_events_failing(cal_id, channel_id, address, token, credentials):
+        if cal_id == "family123456789@group.calendar.google.com":
+            raise ConnectionError("Push notifications are not supported by this resource")
+        return watch_cal_events(cal_id, channel_id, address, token, credentials)
+    google_apis.watch_cal_events = watch_cal_events_failing
+
+    failing = set()
+    downloads = []
+
+    def request_cal_as_ical(cal_id, credentials):
+        if cal_id in failing:
+            raise ConnectionError("Connection reset")
+        downloads.append(cal_id)
+        return _read_data_file(cal_id + ".ics")
+    google_apis.request_cal_as_ical = request_cal_as_ical
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc.run(["noop", "foo.bar@gmail.com", "--webhook-url", "https://example.com/hook", "-c", conf_dir, "-o", output_dir])
+    receiver = NotificationReceiver("127.0.0.1", 0, "secret")
+    receiver.start()
+    watcher = threading.Thread(target=gc._watch, args=(receiver,))
+    watcher.start()
+    try:
+        # The calendar that can't be watched doesn't keep the others from being
+        _wait_for(lambda: len(channels) == 2)
+        downloads.clear()
+
+        # A failed sync doesn't end the watch, and is retried as a full sync
+        google_apis.request_cal_list = lambda credentials: _read_data_file_json("cal_list_less_alt_etag.json")
+        failing.add("foo.bar@gmail.com")
+        foo_bar_channel_id = next(id for (id, channel) in channels.items() if channel['cal_id'] == "foo.bar@gmail.com")
+        _post_notification(receiver, foo_bar_channel_id, "secret", "exists")
+        _wait_for(lambda: "Sync failed, retrying" in capsys.readouterr().out)
+        failing.clear()
+        _wait_for(lambda: downloads == ["foo.bar@gmail.com"])
+        assert watcher.is_alive()
+    finally:
+        receiver.stop()
+        watcher.join()
+    assert len(channels) == 0
+
+
+def test_watch_channel_failures():
+    google_apis = GoogleApis()
+    channels = _mock_watch_apis(google_apis, expiration=10000)
+    manager = ChannelManager(google_apis, "https://example.com/hook", "secret", renew_margin=1000, retry_interval=100)
+
+    stop_channel = google_apis.stop_channel
+    google_apis.stop_channel = MagicMock(side_effect=ConnectionError("Connection reset"))
+    manager.ensure_channels(["a"], None, now=0)
+    a_channel_id = next(id for (id, channel) in channels.items() if channel['cal_id'] == "a")
+    manager.ensure_channels([], None, now=1)  # a no longer wanted, but can't be stopped
+    assert a_channel_id in channels and manager.resolve(a_channel_id) == (True, "a")
+    assert manager.next_renewal() == 101
+
+    google_apis.stop_channel = stop_channel
+    manager.ensure_channels([], None, now=50)  # not retried yet
+    assert a_channel_id in channels
+    manager.ensure_channels([], None, now=101)
+    assert a_channel_id not in channels and manager.resolve(a_channel_id) == (False, None)
+
+
+def test_watch_channel_renewal():
+    google_apis = GoogleApis()
+    channels = _mock_watch_apis(google_apis, expiration=10000)
+    manager = ChannelManager(google_apis, "https://example.com/hook", "secret", renew_margin=1000)
+
+    manager.ensure_channels(["a", "b"], None, now=0)
+    original_ids = set(channels)
+    assert sorted(str(channel['cal_id']) for channel in channels.values()) == ["None", "a", "b"]
+    assert manager.next_renewal() == 9000
+
+    manager.ensure_channels(["a", "b"], None, now=8999)
+    assert set(channels) == original_ids
+
+    manager.ensure_channels(["a", "c"], None, now=9000)  # all renewed, b dropped, c added
+    assert sorted(str(channel['cal_id']) for channel in channels.values()) == ["None", "a", "c"]
+    assert not original_ids & set(channels)
+    assert all(manager.resolve(id)[0] for id in channels)
+    assert manager.resolve(next(iter(original_ids))) == (False, None)
+
+
+def _mock_watch_apis(google_apis, expiration=None):
+    channels = {}
+
+    def watch(cal_id, channel_id, address, token):
+        channels[channel_id] = {'cal_id': cal_id, 'address': address, 'token': token}
+        channel_expiration = expiration if expiration is not None else time.time() + 7 * 24 * 60 * 60
+        return {'resourceId': f"resource-{channel_id}", 'expiration': str(int(channel_expiration * 1000))}
+    google_apis.watch_cal_list = lambda channel_id, address, token, credentials: watch(None, channel_id, address, token)
+    google_apis.watch_cal_events = lambda cal_id, channel_id, address, token, credentials: watch(cal_id, channel_id, address, token)
+
+    def stop_channel(channel_id, resource_id, credentials):
+        assert resource_id == f"resource-{channel_id}"
+        del channels[channel_id]
+    google_apis.stop_channel = stop_channel
+
+    return channels
+
+
+def _post_notification(receiver, channel_id, token, state):
+    request = urllib.request.Request(f"http://127.0.0.1:{receiver.port}/", data=b"", method="POST", headers={
+        'X-Goog-Channel-ID': channel_id,
+        'X-Goog-Channel-Token': token,
+        'X-Goog-Resource-State': state,
+    })
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 200
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_sync_time_window():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    requests_made = []
+    event_etags = {"foo.bar@gmail.com": [("/events/1.ics", '"1"'), ("/events/2.ics", '"2"')]}
+    google_apis = _get_google_apis_mock(cal_list="less")
+
+    def request_cal_etags(cal_id, credentials, time_min=None, time_max=None):
+        requests_made.append(("etags", cal_id, time_min, time_max))
+        return event_etags.get(cal_id, [])
+    google_apis.request_cal_etags = request_cal_etags
+
+    def request_cal_as_ical(cal_id, credentials, time_min=None, time_max=None):
+        requests_made.append(("ical", cal_id, time_min, time_max))
+        return _read_data_file(cal_id + ".ics")
+    google_apis.request_cal_as_ical = request_cal_as_ical
+
+    def sync(cal_list):
+        google_apis.request_cal_list = lambda credentials: _read_data_file_json(cal_list)
+        gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+        gc.run(["sync", "foo.bar@gmail.com", "foo.bar@gmail.com", "--since", "2019-01-01", "--until", "2020-01-01",
+                "-c", conf_dir, "-o", output_dir])
+
+    sync("cal_list_less.json")
+    _assert_ics_files_match(output_dir, ["foo.bar@gmail.com.2019-01-01-to-2020-01-01.ics"], check_file_content=False)
+    window = (datetime(2019, 1, 1, tzinfo=timezone.utc), datetime(2020, 1, 1, tzinfo=timezone.utc))
+    assert requests_made == [("etags", "foo.bar@gmail.com") + window, ("ical", "foo.bar@gmail.com") + window]
+
+    # Calendar changed, but not within the window: not downloaded again
+    requests_made.clear()
+    sync("cal_list_less_alt_etag.json")
+    assert [request[0] for request in requests_made] == ["etags"]
+
+    # Calendar unchanged: window isn't even checked
+    requests_made.clear()
+    sync("cal_list_less_alt_etag.json")
+    assert requests_made == []
+
+    # Calendar changed within the window
+    event_etags["foo.bar@gmail.com"][1] = ("/events/2.ics", '"3"')
+    sync("cal_list_less.json")
+    assert [request[0] for request in requests_made] == ["etags", "ical"]
+
+
+def test_sync_time_window_clean_and_retry(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    event_etags = [("/events/1.ics", '"1"')]
+    failing = []
+    google_apis = _get_google_apis_mock(cal_list="less")
+    google_apis.request_cal_etags = lambda cal_id, credentials, time_min=None, time_max=None: list(event_etags)
+    request_cal_as_ical = google_apis.request_cal_as_ical
+
+    def request_windowed_cal_as_ical(cal_id, credentials, time_min=None, time_max=None):
+        if failing:
+            raise ConnectionError("Connection reset")
+        return request_cal_as_ical(cal_id, credentials)
+    google_apis.request_cal_as_ical = request_windowed_cal_as_ical
+
+    def sync(*args):
+        gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+        gc.run(["sync", "foo.bar@gmail.com", "--clean", "-c", conf_dir, "-o", output_dir] + list(args))
+
+    sync()
+    sync("--since", "2019-01-01", "--until", "2020-01-01")
+    sync("--since", "2y")
+    # Each --clean kept the full exports and the other window's files
+    _assert_ics_files_match(output_dir, [
+        f"{cal_id}{window}.ics"
+        for cal_id in ["foo.bar@gmail.com", "family123456789@group.calendar.google.com"]
+        for window in ["", ".2019-01-01-to-2020-01-01", ".since-2y"]], check_file_content=False)
+    sync()
+    assert len(glob.glob(os.path.join(output_dir, "*.ics"))) == 6
+
+    # A download that failed, after the window was found to have changed, is retried
+    google_apis.request_cal_list = lambda credentials: _read_data_file_json("cal_list_less_alt_etag.json")
+    event_etags.append(("/events/2.ics", '"2"'))
+    failing.append(True)
+    with pytest.raises(GcalvaultError):
+        sync("--since", "2y")
+    failing.clear()
+    capsys.readouterr()
+    sync("--since", "2y")
+    assert "Downloading calendar 'foo.bar@gmail.com' (since-2y)" in capsys.readouterr().out
+
+
+def test_request_cal_as_ical_time_window(monkeypatch):
+    def calendar_data(tzid, uid):
+        return (
+            "BEGIN:VCALENDAR\nPRODID:-//Google Inc//Google Calendar 70.9054//EN\nVERSION:2.0\n"
+            f"BEGIN:VTIMEZONE\nTZID:{tzid}\nBEGIN:STANDARD\nTZOFFSETFROM:-0700\nEND:STANDARD\nEND:VTIMEZONE\n"
+            f"BEGIN:VEVENT\nUID:{uid}\nSUMMARY:Event\n {uid}\nBEGIN:VALARM\nACTION:DISPLAY\nEND:VALARM\nEND:VEVENT\n"
+            "END:VCALENDAR\n")
+    responses = "".join(
+        f"<D:response><D:href>/events/{uid}.ics</D:href><D:propstat><D:prop><D:getetag>\"{uid}\"</D:getetag>"
+        f"<C:calendar-data>{calendar_data(tzid, uid)}</C:calendar-data></D:prop></D:propstat></D:response>"
+        for (tzid, uid) in [("America/Los_Angeles", "a"), ("America/Los_Angeles", "b"), ("UTC", "c")])
+    multistatus = f'<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">{responses}</D:multistatus>'
+
+    requests_made = []
+
+    def request(method, url, headers=None, data=None):
+        requests_made.append((method, url, headers, data))
+        return MagicMock(content=multistatus.encode('utf-8'))
+    monkeypatch.setattr("gcalvault.gcalvault.requests.request", request)
+
+    ical = GoogleApis().request_cal_as_ical(
+        "foo.bar@gmail.com", MagicMock(token="phony"), time_min=datetime(2019, 1, 1, tzinfo=timezone.utc))
+    (method, url, headers, data) = requests_made[0]
+    assert method == "REPORT"
+    assert url == "https://apidata.googleusercontent.com/caldav/v2/foo.bar%40gmail.com/events"
+    assert headers['Depth'] == "1"
+    assert b'<C:time-range start="20190101T000000Z"/>' in data
+
+    lines = ical.split("\r\n")
+    assert lines[:3] == ["BEGIN:VCALENDAR", "PRODID:-//Google Inc//Google Calendar 70.9054//EN", "VERSION:2.0"]
+    assert lines.count("BEGIN:VTIMEZONE") == 2
+    assert lines.count("BEGIN:VEVENT") == 3
+    assert lines.count("BEGIN:VALARM") == 3
+    assert lines[-2:] == ["END:VCALENDAR", ""]
+    assert [event.summary for event in iter_events(ical)] == ["Eventa", "Eventb", "Eventc"]
+
+    assert GoogleApis().request_cal_etags("foo.bar@gmail.com", MagicMock(token="phony")) == [
+        ("/events/a.ics", '"a"'), ("/events/b.ics", '"b"'), ("/events/c.ics", '"c"')]
+    assert b"calendar-data" not in requests_made[1][3]
+
+
+def test_export(capsys):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    (conf_dir, output_dir) = _setup_dirs()
+    export_dir = output_dir / "export"
+
+    def export(format="parquet"):
+        capsys.readouterr()
+        gc = Gcalvault()
+        gc.run(["export", "foo.bar@gmail.com", "-o", output_dir, "--export-dir", export_dir, "--format", format])
+        return capsys.readouterr().out
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    assert export().count("Exported 4 event(s)") == 2
+
+    table = pyarrow_parquet.read_table(export_dir / "user=foo.bar@gmail.com" / "foo.bar@gmail.com.parquet")
+    assert table.num_rows == 4
+    rows = table.to_pylist()
+    assert rows[0]['calendar_id'] == "foo.bar@gmail.com"
+    assert rows[0]['uid'] == "f7e05df4-3bf2-4bc3-81b9-89d88cec705c"
+    assert (rows[0]['start'], rows[0]['end'], rows[0]['tzid']) == ("2021-06-14T13:00:00", "2021-06-14T14:00:00", "America/Los_Angeles")
+    assert rows[0]['rrule'] == "FREQ=WEEKLY;BYDAY=MO"
+    assert rows[0]['attendees'] == []
+
+    assert export().count("is up to date") == 2
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    assert "Exported 1 event(s) from calendar 'foo.bar@gmail.com'" in export("arrow")
+    output = export()  # the arrow export must not mark the parquet file as up to date
+    assert "Exported 1 event(s) from calendar 'foo.bar@gmail.com'" in output
+    assert output.count("is up to date") == 1
+
+    os.remove(output_dir / "foo.bar@gmail.com.ics")
+    assert "Removed export of calendar 'foo.bar@gmail.com'" in export()
+    for path in export_dir.rglob("*.arrow"):
+        os.remove(path)
+    dataset = pyarrow_parquet.read_table(export_dir)  # partitioned by user
+    assert set(dataset.column('calendar_id').to_pylist()) == {"family123456789@group.calendar.google.com"}
+    assert set(dataset.column('user').to_pylist()) == {"foo.bar@gmail.com"}
+
+
+def test_export_time_window(capsys):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    (conf_dir, output_dir) = _setup_dirs()
+    export_dir = output_dir / "export"
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    google_apis = _get_google_apis_mock(cal_list="less")
+    google_apis.request_cal_etags = lambda cal_id, credentials, time_min=None, time_max=None: [("/events/1.ics", '"1"')]
+    google_apis.request_cal_as_ical = lambda cal_id, credentials, time_min=None, time_max=None: _read_data_file(cal_id + ".ics")
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "--since", "2y", "-c", conf_dir, "-o", output_dir])
+    assert len(glob.glob(os.path.join(output_dir, "*.ics"))) == 4
+
+    # Windowed files are neither exported as calendars of their own, nor
+    # removed from the export of the full files, and the other way around
+    for window_args in [[], ["--since", "2y"], []]:
+        capsys.readouterr()
+        gc = Gcalvault()
+        gc.run(["export", "foo.bar@gmail.com", "-o", output_dir, "--export-dir", export_dir] + window_args)
+        output = capsys.readouterr().out
+        assert "Removed export" not in output
+        assert "calendar 'foo.bar@gmail.com'" in output and "since" not in output
+        out_files = sorted(os.path.basename(file) for file in glob.glob(str(export_dir / "*" / "*.parquet")))
+        assert out_files == ["family123456789@group.calendar.google.com.parquet", "foo.bar@gmail.com.parquet"]
+        assert pyarrow_parquet.read_table(export_dir).num_rows == 8
+
+
+def test_export_arrow_batches():
+    pyarrow_ipc = pytest.importorskip("pyarrow.ipc")
+    (_, output_dir) = _setup_dirs()
+
+    exporter = ColumnarExporter(output_dir, "foo.bar@gmail.com", format='arrow', batch_size=25)
+    cal_file_path = os.path.join(data_dir_path, "en.usa#holiday@group.v.calendar.google.com.ics")
+    assert exporter.export_calendar("holidays", cal_file_path) == 106
+
+    with pyarrow_ipc.open_file(output_dir / "user=foo.bar@gmail.com" / "holidays.arrow") as reader:
+        assert reader.num_record_batches == 5
+        table = reader.read_all()
+    assert table.num_rows == 106
+    assert table.to_pylist()[0]['all_day'] is True
+    assert table.to_pylist()[0]['summary'] == "New Year's Day"
+
+
 def _get_google_oauth2_mock(new_authorization=False, email="foo.bar@gmail.com"):
     def authorize_command_fn(client_id, client_secret, email_addr):
         return "gcalvault authorize"
     google_oauth2 = GoogleOAuth2("gcalvault", authorize_command_fn)
 
-    credentials = MagicMock(token="phony")
+    credentials = MagicMock(token="phony", expiry=None)
     google_oauth2.get_credentials = MagicMock(return_value=(credentials, new_authorization))
 
     user_info = {"email": email}
@@ -423,6 +1754,25 @@ def _get_google_apis_mock(cal_list=None, cal_files={}, cal_files_as_allowlist=Fa
     return google_apis
 
 
+def _get_async_google_apis_mock(cal_list=None):
+    class AsyncGoogleApisMock():
+        in_flight = 0
+        max_in_flight = 0
+
+        async def request_cal_list(self, credentials):
+            cal_list_file = f"cal_list_{cal_list}.json" if cal_list else "cal_list.json"
+            return _read_data_file_json(cal_list_file)
+
+        async def request_cal_as_ical(self, cal_id, credentials):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.05)
+            self.in_flight -= 1
+            return _read_data_file(cal_id + ".ics")
+
+    return AsyncGoogleApisMock()
+
+
 def _assert_ics_files_match(output_dir, expected_files, check_file_content=True):
     actual_files = [os.path.basename(f) for f in glob.glob(os.path.join(output_dir, "*.ics"))]
     assert len(expected_files) == len(actual_files)
@@ -0,0 +1,150 @@
+import os
+import io
+import json
+import time
+import glob
+import contextlib
+import tracemalloc
+import pytest
+from git import Repo
+from gcalvault import Gcalvault
+from gcalvault.gcalvault import GIT_ENGINES
+from gcalvault.history_index import HistoryIndex
+from .synthetic import SyntheticGoogleApis, calendar_ids, changed_calendar_ids, calendar_ics, modified_event_count
+from .test_gcalvault import _get_google_oauth2_mock
+
+# Scale tests, run against synthetic accounts (see synthetic.py). By default
+# they run at a tenth of the target scale (100k-event calendars, 1,000-calendar
+# accounts, 500-commit vaults) to keep the suite fast; run them at full scale
+# with GCALVAULT_TEST_SCALE=1 (or higher). Time budgets are deliberately loose
+# (and include tracemalloc's overhead), they're meant to catch accidentally
+# quadratic behavior, not to benchmark.
+
+
+SCALE = float(os.environ.get("GCALVAULT_TEST_SCALE", "0.1"))
+EVENT_COUNT = max(int(100_000 * SCALE), 100)
+CALENDAR_COUNT = max(int(1_000 * SCALE), 10)
+REVISION_COUNT = max(int(500 * SCALE), 20)
+
+MB = 1024 * 1024
+
+
+def test_sync_large_calendar(tmp_path):
+    (conf_dir, output_dir) = (tmp_path / "conf", tmp_path / "output")
+    google_apis = SyntheticGoogleApis(1, EVENT_COUNT)
+    google_apis.prepare()
+    ical_size = len(google_apis.request_cal_as_ical(calendar_ids(1)[0], None))
+    changes_file = tmp_path / "changes.json"
+
+    def sync():
+        gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir, "--changes-file", changes_file])
+
+    (elapsed, peak) = _measure(sync)
+    assert os.path.getsize(output_dir / "cal00000@group.calendar.google.com.ics") == ical_size
+    assert len(json.loads(changes_file.read_text())['calendars'][0]['added']) == EVENT_COUNT
+    assert elapsed < EVENT_COUNT / 1000 + 10
+    # Parsing for the event diff must not hold more than a small multiple of the calendar itself
+    assert peak < 3 * ical_size + 16 * MB
+
+    # Calendar 0 changes every tenth revision, each time modifying 1% of its events
+    google_apis.revision = 10
+    google_apis.prepare()
+    (elapsed, peak) = _measure(sync)
+    changes = json.loads(changes_file.read_text())['calendars'][0]
+    assert (len(changes['added']), len(changes['modified']), len(changes['deleted'])) == \
+        (0, modified_event_count(EVENT_COUNT, 1), 0)
+    assert elapsed < EVENT_COUNT / 1000 + 10
+    assert peak < 3 * ical_size + 16 * MB
+    assert len(list(Repo(output_dir).iter_commits())) == 3
+
+
+def test_sync_many_calendars_and_clean(tmp_path):
+    (conf_dir, output_dir) = (tmp_path / "conf", tmp_path / "output")
+    google_apis = SyntheticGoogleApis(CALENDAR_COUNT, 20)
+    google_apis.prepare()
+
+    def sync(*args):
+        gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir, "--git-engine", "fast-import", *args])
+
+    (elapsed, peak) = _measure(sync)
+    assert len(glob.glob(os.path.join(output_dir, "*.ics"))) == CALENDAR_COUNT
+    assert elapsed < CALENDAR_COUNT / 50 + 10
+    assert peak < 64 * MB
+
+    # Only calendars whose etag changed are downloaded again
+    google_apis.revision = 1
+    google_apis.prepare()
+    google_apis.downloaded = []
+    (elapsed, _) = _measure(sync)
+    assert google_apis.downloaded == changed_calendar_ids(CALENDAR_COUNT, 1)
+    assert elapsed < 30 * SCALE + 10
+
+    # Half of the calendars go away
+    google_apis.calendar_count = CALENDAR_COUNT // 2
+    (elapsed, peak) = _measure(lambda: sync("--clean"))
+    assert sorted(os.path.basename(f) for f in glob.glob(os.path.join(output_dir, "*.ics"))) == \
+        [f"{cal_id}.ics" for cal_id in calendar_ids(CALENDAR_COUNT // 2)]
+    assert elapsed < 30 * SCALE + 10
+    assert peak < 64 * MB
+
+    repo = Repo(output_dir)
+    assert len(list(repo.iter_commits())) == 4
+    assert len(repo.head.commit.tree.blobs) == CALENDAR_COUNT // 2 + 1  # .gitignore
+    assert not repo.is_dirty(untracked_files=True)
+
+
+@pytest.mark.parametrize("git_engine", GIT_ENGINES.keys())
+def test_vault_deep_history(tmp_path, git_engine):
+    cal_ids = calendar_ids(20)
+    commit_times = []
+
+    # A quarter of the calendars change at each revision, with 10% of their events modified
+    def changed_at(i, revision):
+        return revision == 0 or i % 4 == revision % 4
+
+    def content(cal_id, revision):
+        return calendar_ics(cal_id, 50, revision, changed_every=10)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for revision in range(REVISION_COUNT):
+            repo = GIT_ENGINES[git_engine]("gcalvault", "scale-test", str(tmp_path), [".ics"])
+            start = time.perf_counter()
+            for (i, cal_id) in enumerate(cal_ids):
+                if changed_at(i, revision):
+                    (tmp_path / f"{cal_id}.ics").write_text(content(cal_id, revision))
+                    repo.add_file(f"{cal_id}.ics")
+            repo.commit(f"gcalvault sync {revision}")
+            commit_times.append(time.perf_counter() - start)
+
+    assert len(list(Repo(tmp_path).iter_commits())) == REVISION_COUNT + 1
+    # Commits must not get slower as history gets deeper
+    window = len(commit_times) // 4
+    early = sorted(commit_times[1:window + 1])[window // 2]
+    late = sorted(commit_times[-window:])[window // 2]
+    assert late < 3 * early + 0.05
+
+    # Looking up a file deep in history, after indexing it all
+    history = HistoryIndex(tmp_path)
+    (elapsed, peak) = _measure(history.refresh)
+    assert elapsed < 30 * SCALE + 10
+    assert peak < 32 * MB
+    revision = REVISION_COUNT // 2 + 1
+    commit = next(c for c in Repo(tmp_path).iter_commits() if c.message.strip() == f"gcalvault sync {revision}")
+    for (i, cal_id) in enumerate(cal_ids[:4]):
+        written_at = max(r for r in range(revision + 1) if changed_at(i, r))
+        out = io.BytesIO()
+        history.stream_blob(history.find_blob_at_commit(f"{cal_id}.ics", commit.hexsha), out)
+        assert out.getvalue().decode('utf-8') == content(cal_id, written_at)
+
+
+def _measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        return (time.perf_counter() - start, tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()